@@ -0,0 +1,41 @@
+"""requests next_attempt_at
+
+Revision ID: 9a4d03e6c1b8
+Revises: 5c1e7a9b2f30
+Create Date: 2026-10-18 11:47:05.618094
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a4d03e6c1b8'
+down_revision: Union[str, Sequence[str], None] = '5c1e7a9b2f30'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+tables = ('handler_notification_request', 'payment_request', 'refund_request')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for table in tables:
+        op.add_column(table, sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+        op.add_column(table, sa.Column('attempts', sa.Integer(), server_default='0', nullable=False))
+        op.execute(f'UPDATE {table} SET next_attempt_at = coalesce(lease_until, processed_at, created_at)')
+        op.alter_column(table, 'next_attempt_at', nullable=False)
+        op.create_index(op.f(f'ix_{table}_next_attempt_at'), table, ['next_attempt_at'], unique=False)
+        op.drop_index(op.f(f'ix_{table}_processed_at'), table_name=table)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in tables:
+        op.create_index(op.f(f'ix_{table}_processed_at'), table, ['processed_at'], unique=False)
+        op.drop_index(op.f(f'ix_{table}_next_attempt_at'), table_name=table)
+        op.drop_column(table, 'attempts')
+        op.drop_column(table, 'next_attempt_at')
@@ -0,0 +1,31 @@
+"""handler host
+
+Revision ID: 3f6b2c8e90d7
+Revises: e2b87f15d6a4
+Create Date: 2026-10-18 15:21:30.118462
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f6b2c8e90d7'
+down_revision: Union[str, Sequence[str], None] = 'e2b87f15d6a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('handler_notification_request', sa.Column('handler_host', sa.String(), nullable=True))
+    # То же, что urlsplit(handler_url).netloc
+    op.execute("UPDATE handler_notification_request SET handler_host = coalesce(substring(handler_url from '^[^:/?#]+://([^/?#]*)'), '')")
+    op.alter_column('handler_notification_request', 'handler_host', nullable=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('handler_notification_request', 'handler_host')
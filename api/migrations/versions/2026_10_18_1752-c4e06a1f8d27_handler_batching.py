@@ -0,0 +1,35 @@
+"""handler batching
+
+Revision ID: c4e06a1f8d27
+Revises: 7b91d4e2a5c3
+Create Date: 2026-10-18 17:52:41.906125
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e06a1f8d27'
+down_revision: Union[str, Sequence[str], None] = '7b91d4e2a5c3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('payment_request', sa.Column('handler_batching', sa.Boolean(), server_default='false', nullable=False))
+    op.add_column('refund_request', sa.Column('handler_batching', sa.Boolean(), server_default='false', nullable=False))
+    op.add_column('handler_notification_request', sa.Column('batching', sa.Boolean(), server_default='false', nullable=False))
+    op.add_column('handler_notification_dead_letter', sa.Column('batching', sa.Boolean(), server_default='false', nullable=False))
+    op.alter_column('handler_notification_dead_letter', 'batching', server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('handler_notification_dead_letter', 'batching')
+    op.drop_column('handler_notification_request', 'batching')
+    op.drop_column('refund_request', 'handler_batching')
+    op.drop_column('payment_request', 'handler_batching')
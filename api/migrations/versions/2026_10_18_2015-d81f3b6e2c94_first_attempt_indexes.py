@@ -0,0 +1,36 @@
+"""first attempt indexes
+
+Revision ID: d81f3b6e2c94
+Revises: c4e06a1f8d27
+Create Date: 2026-10-18 20:15:08.271946
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd81f3b6e2c94'
+down_revision: Union[str, Sequence[str], None] = 'c4e06a1f8d27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+tables = ('payment_request', 'refund_request', 'handler_notification_request')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for table in tables:
+        op.create_index(
+            f'ix_{table}_first_attempt', table, ['next_attempt_at'],
+            unique=False, postgresql_where=sa.text('attempts = 0')
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in tables:
+        op.drop_index(f'ix_{table}_first_attempt', table_name=table, postgresql_where=sa.text('attempts = 0'))
@@ -0,0 +1,36 @@
+"""trace id
+
+Revision ID: e5a7c0b3f418
+Revises: d81f3b6e2c94
+Create Date: 2026-10-18 21:12:07.534816
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a7c0b3f418'
+down_revision: Union[str, Sequence[str], None] = 'd81f3b6e2c94'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('payment_request', sa.Column('trace_id', sa.String(), nullable=True))
+    op.add_column('refund_request', sa.Column('trace_id', sa.String(), nullable=True))
+    op.add_column('handler_notification_request', sa.Column('trace_id', sa.String(), nullable=True))
+    op.add_column('handler_notification_dead_letter', sa.Column('trace_id', sa.String(), nullable=True))
+    op.add_column('outbox', sa.Column('trace_id', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('outbox', 'trace_id')
+    op.drop_column('handler_notification_dead_letter', 'trace_id')
+    op.drop_column('handler_notification_request', 'trace_id')
+    op.drop_column('refund_request', 'trace_id')
+    op.drop_column('payment_request', 'trace_id')
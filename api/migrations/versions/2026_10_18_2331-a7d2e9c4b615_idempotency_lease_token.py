@@ -0,0 +1,30 @@
+"""idempotency lease token
+
+Revision ID: a7d2e9c4b615
+Revises: f29c6d8a1e05
+Create Date: 2026-10-18 23:31:12.406918
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d2e9c4b615'
+down_revision: Union[str, Sequence[str], None] = 'f29c6d8a1e05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('idempotency_key', sa.Column('lease_token', sa.Uuid(), nullable=True))
+    op.execute('UPDATE idempotency_key SET lease_token = gen_random_uuid()')
+    op.alter_column('idempotency_key', 'lease_token', nullable=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('idempotency_key', 'lease_token')
@@ -0,0 +1,32 @@
+"""request lease token
+
+Revision ID: c3e8b1f4a920
+Revises: a7d2e9c4b615
+Create Date: 2026-10-19 00:12:41.208315
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3e8b1f4a920'
+down_revision: Union[str, Sequence[str], None] = 'a7d2e9c4b615'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('payment_request', sa.Column('lease_token', sa.Uuid(), nullable=True))
+    op.add_column('refund_request', sa.Column('lease_token', sa.Uuid(), nullable=True))
+    op.add_column('handler_notification_request', sa.Column('lease_token', sa.Uuid(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('handler_notification_request', 'lease_token')
+    op.drop_column('refund_request', 'lease_token')
+    op.drop_column('payment_request', 'lease_token')
@@ -0,0 +1,42 @@
+"""handler batching indexes
+
+Revision ID: 5d0a7c3e9b18
+Revises: c3e8b1f4a920
+Create Date: 2026-10-19 00:40:17.593204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d0a7c3e9b18'
+down_revision: Union[str, Sequence[str], None] = 'c3e8b1f4a920'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        'ix_handler_notification_request_batching', 'handler_notification_request', ['next_attempt_at'],
+        unique=False, postgresql_where=sa.text('batching IS true')
+    )
+    op.create_index(
+        'ix_handler_notification_request_batching_url', 'handler_notification_request', ['handler_url', 'next_attempt_at'],
+        unique=False, postgresql_where=sa.text('batching IS true')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(
+        'ix_handler_notification_request_batching_url', table_name='handler_notification_request',
+        postgresql_where=sa.text('batching IS true')
+    )
+    op.drop_index(
+        'ix_handler_notification_request_batching', table_name='handler_notification_request',
+        postgresql_where=sa.text('batching IS true')
+    )
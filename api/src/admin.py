@@ -0,0 +1,35 @@
+import asyncio
+import typer
+
+from worker.notify_handlers import requeue_dead_letters
+from services.idempotency import purge_expired_keys
+
+
+app = typer.Typer()
+
+
+# Без callback typer запускал бы единственную команду без имени
+@app.callback()
+def main():
+    pass
+
+
+@app.command('requeue-dead-letters')
+def requeue_dead_letters_command(
+    handler_url: str | None = typer.Option(default=None, help='Только уведомления для этого обработчика')
+):
+    '''Вернуть недоставленные уведомления обработчикам из dead letters в очередь'''
+    requeued = asyncio.run(requeue_dead_letters(handler_url))
+    typer.echo(f'requeued {requeued} notification(s)')
+
+
+
+@app.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    '''Удалить ключи идемпотентности старше BILL_API_IDEMPOTENCY_KEY_TTL'''
+    purged = asyncio.run(purge_expired_keys())
+    typer.echo(f'purged {purged} idempotency key(s)')
+
+
+if __name__ == '__main__':
+    app()
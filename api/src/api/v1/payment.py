@@ -1,15 +1,71 @@
 from typing import Annotated, Literal, Any
 from uuid import UUID
 from decimal import Decimal
-from fastapi import APIRouter, Body, Depends, Path
+from fastapi import APIRouter, Body, Depends, Header, Path, Query, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field, HttpUrl
 
-from services.payment import PaymentService, ChargeInfo, get_payment_service
+from services.payment import PaymentService, PaymentParams, PaymentBatchItem, ChargeInfo, get_payment_service
+from services.status import Status, PaymentInfo, payment_status, wait_payment_status
+from settings import settings
 
 
 router = APIRouter()
 
 
+IdempotencyKeyHeader = Annotated[str | None, Header(alias='Idempotency-Key', max_length=255, description=
+    'Повтор запроса с тем же ключом (например, после таймаута) вернет ответ первого запроса, не выполняя его снова<br>'
+    'Ключ хранится сутки, и его нельзя использовать с другими параметрами запроса'
+)]
+
+
+IfNoneMatchHeader = Annotated[str | None, Header(alias='If-None-Match')]
+
+
+# 304, если у клиента уже есть ответ с тем же ETag
+def status_response(status: Status, if_none_match: str | None) -> Response:
+    if if_none_match is not None:
+        etags = [etag.strip().removeprefix('W/') for etag in if_none_match.split(',')]
+        if '*' in etags or status.etag in etags:
+            return Response(status_code=304, headers={'ETag': status.etag})
+
+    return Response(content=status.body, media_type='application/json', headers={'ETag': status.etag})
+
+
+@router.get(
+    path='/{payment_id}',
+    response_model=PaymentInfo,
+    responses={404: {}, 304: {}},
+    description=
+    'Статус платежа. Ответ содержит ETag, с If-None-Match вернется 304, если статус не изменился'
+)
+async def get_payment(
+    payment_id: Annotated[UUID, Path()],
+    if_none_match: IfNoneMatchHeader = None
+) -> Response:
+    if (status := await payment_status(payment_id)) is None:
+        return ORJSONResponse(status_code=404, content={'message': 'payment with such id doesn\'t exist'})
+    return status_response(status, if_none_match)
+
+
+@router.get(
+    path='/{payment_id}/wait',
+    response_model=PaymentInfo,
+    responses={404: {}, 304: {}},
+    description=
+    'Статус платежа, как только он завершится (succeeded или cancelled), но не позже timeout секунд<br>'
+    'По истечении timeout возвращается текущий статус'
+)
+async def wait_payment(
+    payment_id: Annotated[UUID, Path()],
+    timeout: Annotated[float, Query(gt=0.0, le=settings.payment_wait_max_timeout)] = 30.0,
+    if_none_match: IfNoneMatchHeader = None
+) -> Response:
+    if (status := await wait_payment_status(payment_id, timeout)) is None:
+        return ORJSONResponse(status_code=404, content={'message': 'payment with such id doesn\'t exist'})
+    return status_response(status, if_none_match)
+
+
 class PaymentBody(BaseModel):
     user_id: UUID
     amount: Decimal = Field(gt=0.0)
@@ -18,6 +74,10 @@ class PaymentBody(BaseModel):
         'Клиенту необходимо указать URL, по которому он будет уведомлен о совершении платежа<br>'
         'Обработчик должен принимать post запрос, и должен быть идемпотентным'
     )
+    handler_batching: bool = Field(default=False, description=
+        'Уведомления для одного handler_url копятся некоторое время и отправляются одним post запросом (массивом)<br>'
+        'Массив подтверждается или отправляется повторно целиком'
+    )
     return_url: HttpUrl
     extra_data: dict[str, Any] | None = Field(default=None)
     card_data: dict[str, Any] | None = Field(default=None)
@@ -32,16 +92,48 @@ class PaymentBody(BaseModel):
 )
 async def create_payment(
     body: Annotated[PaymentBody, Body()],
-    payments_service: Annotated[PaymentService, Depends(get_payment_service)]
+    payments_service: Annotated[PaymentService, Depends(get_payment_service)],
+    idempotency_key: IdempotencyKeyHeader = None
 ) -> ChargeInfo:
     return await payments_service.payment(
         user_id=body.user_id,
         handler_url=str(body.handler_url) if body.handler_url else None,
+        handler_batching=body.handler_batching,
         return_url=str(body.return_url),
         amount=body.amount,
         currency=body.currency,
         extra_data=body.extra_data,
-        card_data=body.card_data
+        card_data=body.card_data,
+        idempotency_key=idempotency_key
+    )
+
+
+@router.post(
+    path='/batch',
+    description=
+    'Создает несколько платежей за один запрос (например, при продлении подписок)<br>'
+    'Ответ - в порядке платежей в запросе: созданный платеж, или ошибка его создания (error)'
+)
+async def create_payments(
+    body: Annotated[list[PaymentBody], Body(min_length=1, max_length=settings.payment_batch_max_size)],
+    payments_service: Annotated[PaymentService, Depends(get_payment_service)],
+    idempotency_key: IdempotencyKeyHeader = None
+) -> list[PaymentBatchItem]:
+    return await payments_service.payments(
+        [
+            PaymentParams(
+                user_id=item.user_id,
+                handler_url=str(item.handler_url) if item.handler_url else None,
+                handler_batching=item.handler_batching,
+                return_url=str(item.return_url),
+                amount=item.amount,
+                currency=item.currency,
+                extra_data=item.extra_data,
+                card_data=item.card_data
+            )
+            for item in body
+        ],
+        idempotency_key=idempotency_key
     )
 
 
@@ -52,6 +144,10 @@ class RefundBody(BaseModel):
         'Клиенту необходимо указать URL, по которому он будет уведомлен о совершении возврата<br>'
         'Обработчик должен принимать post запрос, и должен быть идемпотентным'
     )
+    handler_batching: bool = Field(default=False, description=
+        'Уведомления для одного handler_url копятся некоторое время и отправляются одним post запросом (массивом)<br>'
+        'Массив подтверждается или отправляется повторно целиком'
+    )
     extra_data: dict[str, Any] | None = None
 
 
@@ -62,12 +158,15 @@ class RefundBody(BaseModel):
 async def create_refund(
     payment_id: Annotated[UUID, Path()],
     body: Annotated[RefundBody, Body()],
-    payments_service: Annotated[PaymentService, Depends(get_payment_service)]
+    payments_service: Annotated[PaymentService, Depends(get_payment_service)],
+    idempotency_key: IdempotencyKeyHeader = None
 ) -> None:
     await payments_service.refund(
         payment_id=payment_id,
         handler_url=str(body.handler_url) if body.handler_url else None,
+        handler_batching=body.handler_batching,
         amount=body.amount,
         currency=body.currency,
-        extra_data=body.extra_data
+        extra_data=body.extra_data,
+        idempotency_key=idempotency_key
     )
@@ -0,0 +1,59 @@
+from typing import Annotated
+from uuid import UUID
+from fastapi import APIRouter, Body, Depends, Path, Response
+from fastapi.responses import ORJSONResponse
+
+from api.v1.payment import RefundBody, IdempotencyKeyHeader, IfNoneMatchHeader, status_response
+from services.payment import PaymentService, RefundParams, RefundBatchItem, get_payment_service
+from services.status import RefundInfo, refund_status
+from settings import settings
+
+
+router = APIRouter()
+
+
+class RefundBatchBody(RefundBody):
+    payment_id: UUID
+
+
+@router.post(
+    path='/batch',
+    description=
+    'Создает запросы на совершение нескольких возвратов (например, массовый возврат после инцидента)<br>'
+    'Ответ - в порядке возвратов в запросе: id созданного возврата, или ошибка (error), если платеж не существует'
+)
+async def create_refunds(
+    body: Annotated[list[RefundBatchBody], Body(min_length=1, max_length=settings.refund_batch_max_size)],
+    payments_service: Annotated[PaymentService, Depends(get_payment_service)],
+    idempotency_key: IdempotencyKeyHeader = None
+) -> list[RefundBatchItem]:
+    return await payments_service.refunds(
+        [
+            RefundParams(
+                payment_id=item.payment_id,
+                handler_url=str(item.handler_url) if item.handler_url else None,
+                handler_batching=item.handler_batching,
+                amount=item.amount,
+                currency=item.currency,
+                extra_data=item.extra_data
+            )
+            for item in body
+        ],
+        idempotency_key=idempotency_key
+    )
+
+
+@router.get(
+    path='/{refund_id}',
+    response_model=RefundInfo,
+    responses={404: {}, 304: {}},
+    description=
+    'Статус возврата. Ответ содержит ETag, с If-None-Match вернется 304, если статус не изменился'
+)
+async def get_refund(
+    refund_id: Annotated[UUID, Path()],
+    if_none_match: IfNoneMatchHeader = None
+) -> Response:
+    if (status := await refund_status(refund_id)) is None:
+        return ORJSONResponse(status_code=404, content={'message': 'refund with such id doesn\'t exist'})
+    return status_response(status, if_none_match)
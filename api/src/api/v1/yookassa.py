@@ -0,0 +1,39 @@
+import logging
+from typing import Annotated, Literal, Any
+from fastapi import APIRouter, Body, Depends
+from pydantic import BaseModel
+
+from services.payment import PaymentService, get_payment_service
+
+
+logger = logging.getLogger('yookassa-notifications')
+
+router = APIRouter()
+
+
+# https://yookassa.ru/developers/using-api/webhooks#notification-object
+class NotificationBody(BaseModel):
+    type: Literal['notification']
+    event: str
+    object: dict[str, Any]
+
+
+@router.post(
+    path='/notifications',
+    description=
+    'Входящие уведомления (веб-хук) от Yookassa<br>'
+    'Уведомление только ускоряет проверку статуса платежа, сам статус воркер запрашивает у Yookassa'
+)
+async def yookassa_notification(
+    body: Annotated[NotificationBody, Body()],
+    payments_service: Annotated[PaymentService, Depends(get_payment_service)]
+) -> None:
+    # Yookassa повторяет уведомление, пока не получит 200, поэтому на неизвестные уведомления тоже отвечаем 200,
+    # а если платеж сейчас проверяет воркер - 503 (см. PaymentService.external_payment_notification)
+    # Возвраты мы создаем синхронно, уведомления о них не нужны
+    if not body.event.startswith('payment.') or 'id' not in body.object:
+        logger.info(f'ignoring yookassa notification "{body.event}"')
+        return
+
+    if not await payments_service.external_payment_notification(str(body.object['id'])):
+        logger.warning(f'got yookassa notification "{body.event}" for unknown or already processed payment {body.object['id']}')
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import psycopg
+from typing import Callable
+from collections import defaultdict
+from psycopg import sql
+
+from settings import pg_settings
+
+
+logger = logging.getLogger('postgres-listener')
+
+
+# Одно выделенное соединение на процесс, слушающее LISTEN каналы и раздающее уведомления подписчикам.
+# Соединение не берется из пула и не держит транзакцию
+class Listener:
+    def __init__(self, channels: list[str], reconnect_delay: float = 1.0):
+        self.channels = channels
+        self.reconnect_delay = reconnect_delay
+        self._callbacks = defaultdict[str, list[Callable[[str], None]]](list)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> Callable[[], None]:
+        assert channel in self.channels, channel
+        self._callbacks[channel].append(callback)
+        return lambda: self._callbacks[channel].remove(callback)
+
+    async def run(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    pg_settings.get_url(driver=None),
+                    autocommit=True
+                ) as conn:
+                    for channel in self.channels:
+                        await conn.execute(sql.SQL('LISTEN {}').format(sql.Identifier(channel)))
+
+                    # Пока соединения не было, уведомления могли быть пропущены
+                    for channel in self.channels:
+                        self._dispatch(channel, '')
+
+                    async for notify in conn.notifies():
+                        self._dispatch(notify.channel, notify.payload)
+            except psycopg.OperationalError as e:
+                logger.warning(f'listener connection error: {str(e)}')
+            # Без слушателя кэши статусов не сбрасываются, поэтому он переподключается после любой ошибки
+            except Exception:
+                logger.exception('listener error')
+
+            await asyncio.sleep(self.reconnect_delay)
+
+    # Ошибка одного подписчика не должна мешать остальным и рвать соединение
+    def _dispatch(self, channel: str, payload: str):
+        for callback in list(self._callbacks[channel]):
+            try:
+                callback(payload)
+            except Exception:
+                logger.exception(f'listener callback error (channel {channel}, payload "{payload}")')
@@ -1,11 +1,72 @@
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import time
+from uuid import UUID
+import sqlalchemy.exc
+from sqlalchemy import select, func, event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+import metrics
+import tracing
 from settings import pg_settings
 
 
+# Пул с метриками (см. metrics.db_pool_*): ожидание соединения, выданные соединения и переполнение
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def _do_get(self) -> ConnectionPoolEntry:
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            metrics.db_pool_timeouts.inc()
+            raise
+        finally:
+            waited = time.monotonic() - started
+            metrics.db_pool_checkout_wait.observe(waited)
+            metrics.spent('postgres_pool', waited)
+            self._observe()
+
+    def _do_return_conn(self, record: ConnectionPoolEntry):
+        super()._do_return_conn(record)
+        self._observe()
+
+    def _observe(self):
+        metrics.db_pool_size.set(self.size())
+        metrics.db_pool_in_use.set(self.checkedout())
+        metrics.db_pool_overflow.set(max(self.overflow(), 0))
+
+
 engine = create_async_engine(
     pg_settings.get_url('psycopg'),
+    poolclass=InstrumentedPool,
     pool_size=20,
     max_overflow=30,
 )
 
-session_maker = async_sessionmaker(engine)
\ No newline at end of file
+session_maker = async_sessionmaker(engine)
+
+
+# Время запросов учитывается в metrics.request_dependency_duration текущего HTTP запроса,
+# и каждый запрос записывается спаном текущей трассы (см. tracing).
+# Соединение выполняет один запрос за раз, поэтому начало хранится прямо в info соединения
+@event.listens_for(engine.sync_engine, 'before_cursor_execute')
+def on_before_cursor_execute(conn, cursor, statement, parameters, context, executemany: bool):
+    conn.info['query_started'] = time.monotonic()
+
+
+@event.listens_for(engine.sync_engine, 'after_cursor_execute')
+def on_after_cursor_execute(conn, cursor, statement, parameters, context, executemany: bool):
+    if (started := conn.info.pop('query_started', None)) is not None:
+        metrics.spent('postgres', time.monotonic() - started)
+        tracing.record('postgres', started, statement=statement[:200], executemany=executemany)
+
+
+# Уведомление доставляется слушателям только после коммита транзакции
+async def notify(session: AsyncSession, channel: str, payload: str = ''):
+    await session.execute(select(func.pg_notify(channel, payload)))
+
+
+# id через запятую. payload ограничен 8000 байт, поэтому id разбиваются на несколько уведомлений
+async def notify_ids(session: AsyncSession, channel: str, ids: list[UUID], chunk_size: int = 200):
+    for i in range(0, len(ids), chunk_size):
+        await notify(session, channel, ','.join(str(id) for id in ids[i:i + chunk_size]))
+
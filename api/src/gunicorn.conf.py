@@ -0,0 +1,18 @@
+import os
+import shutil
+
+
+# Воркеры gunicorn пишут метрики в общий каталог, /metrics любого воркера отдает их сумму (см. metrics.py).
+# Переменная задается до запуска воркеров, то есть до импорта prometheus_client в них
+prometheus_multiproc_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/bill-api-metrics')
+
+
+def on_starting(server):
+    # Значения от предыдущего запуска
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
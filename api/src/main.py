@@ -1,16 +1,29 @@
+import time
+import anyio
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.responses import ORJSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST
 
 import db.postgres
+import metrics
+import tracing
 import api.v1.payment
+import api.v1.refund
+import api.v1.yookassa
 import services.payment
+import services.idempotency
+import services.status
 
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    yield
+    tracing.configure()
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(services.status.listener().run)
+        yield
+        tg.cancel_scope.cancel()
     await db.postgres.engine.dispose()
 
 
@@ -24,6 +37,49 @@ app = FastAPI(
 
 
 app.include_router(api.v1.payment.router, prefix='/api/v1/payment', tags=['Payment'])
+app.include_router(api.v1.refund.router, prefix='/api/v1/refund', tags=['Refund'])
+app.include_router(api.v1.yookassa.router, prefix='/api/v1/yookassa', tags=['Yookassa'])
+
+
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics() -> Response:
+    return Response(content=metrics.latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+# Маршрут берется шаблоном (/api/v1/payment/{payment_id}), чтобы не плодить метрики на каждый id
+@app.middleware('http')
+async def record_request_metrics(request: Request, call_next):
+    started = time.monotonic()
+    status = 500
+    with metrics.track_dependencies() as dependencies:
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = request.scope.get('route')
+            metrics.observe_request(
+                request.method,
+                getattr(route, 'path', 'unmatched'),
+                status,
+                time.monotonic() - started,
+                dependencies
+            )
+
+
+# Трасса запроса продолжается в воркере (см. tracing), X-Request-Id возвращается в ответе
+@app.middleware('http')
+async def trace_request(request: Request, call_next):
+    with tracing.trace(
+        request.headers.get(tracing.REQUEST_ID_HEADER),
+        f'{request.method} {request.url.path}'
+    ) as root:
+        response = await call_next(request)
+        if (route := request.scope.get('route')) is not None:
+            root.name = f'{request.method} {getattr(route, 'path', request.url.path)}'
+        root.attributes['status'] = response.status_code
+        response.headers[tracing.REQUEST_ID_HEADER] = root.trace_id
+        return response
 
 
 @app.exception_handler(services.payment.PaymentDoesntExistError)
@@ -39,4 +95,20 @@ async def on_external_payment_service_error(request, exc):
     return ORJSONResponse(
         status_code=500,
         content={'message': 'external payment service error'}
+    )
+
+
+@app.exception_handler(services.payment.PaymentRequestInProgressError)
+async def on_payment_request_in_progress_error(request, exc):
+    return ORJSONResponse(
+        status_code=503,
+        content={'message': 'payment is being checked, retry later'}
+    )
+
+
+@app.exception_handler(services.idempotency.IdempotencyKeyReusedError)
+async def on_idempotency_key_reused_error(request, exc):
+    return ORJSONResponse(
+        status_code=422,
+        content={'message': 'idempotency key was already used with different request parameters'}
     )
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+import time
+import httpx
+import prometheus_client
+from typing import Any, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import multiprocess
+
+
+# Метрики API. Под gunicorn каждый воркер пишет значения в общий каталог PROMETHEUS_MULTIPROC_DIR
+# (задается в gunicorn.conf.py), а /metrics собирает их со всех воркеров (см. latest).
+# Метрики пула соединений общие для API и воркера (см. db.postgres.InstrumentedPool)
+
+
+request_duration = prometheus_client.Histogram(
+    'bill_api_request_duration_seconds', 'Обработка HTTP запроса',
+    ['method', 'route'], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+responses = prometheus_client.Counter('bill_api_responses', 'Ответы по статусу', ['method', 'route', 'status'])
+# Сколько из обработки запроса ушло на внешние зависимости: yookassa, postgres (запросы), postgres_pool (ожидание соединения)
+request_dependency_duration = prometheus_client.Histogram(
+    'bill_api_request_dependency_duration_seconds', 'Время внешних зависимостей за один HTTP запрос',
+    ['method', 'route', 'dependency'], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+yookassa_request_duration = prometheus_client.Histogram(
+    'bill_api_yookassa_request_duration_seconds', 'Запросы к Yookassa',
+    ['endpoint'], buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+db_pool_checkout_wait = prometheus_client.Histogram(
+    'bill_db_pool_checkout_wait_seconds', 'Ожидание соединения из пула',
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0)
+)
+db_pool_timeouts = prometheus_client.Counter('bill_db_pool_timeouts', 'Соединение из пула не получено за pool_timeout')
+# liveall - значение по каждому живому процессу: пул у каждого воркера gunicorn свой
+db_pool_size = prometheus_client.Gauge('bill_db_pool_size', 'Постоянные соединения пула', multiprocess_mode='liveall')
+db_pool_in_use = prometheus_client.Gauge('bill_db_pool_in_use', 'Выданные соединения', multiprocess_mode='liveall')
+db_pool_overflow = prometheus_client.Gauge(
+    'bill_db_pool_overflow', 'Соединения сверх pool_size (до max_overflow)', multiprocess_mode='liveall'
+)
+
+
+# Время зависимостей текущего HTTP запроса. Словарь изменяемый, поэтому он же виден
+# в задачах и гринлетах SQLAlchemy, которые копируют контекст запроса
+_dependencies = ContextVar[dict[str, float] | None]('dependencies', default=None)
+
+
+def spent(dependency: str, duration: float):
+    if (dependencies := _dependencies.get()) is not None:
+        dependencies[dependency] = dependencies.get(dependency, 0.0) + duration
+
+
+@contextmanager
+def track_dependencies() -> Iterator[dict[str, float]]:
+    dependencies = dict[str, float]()
+    token = _dependencies.set(dependencies)
+    try:
+        yield dependencies
+    finally:
+        _dependencies.reset(token)
+
+
+def observe_request(method: str, route: str, status: int, duration: float, dependencies: dict[str, float]):
+    request_duration.labels(method, route).observe(duration)
+    responses.labels(method, route, str(status)).inc()
+    for dependency, dependency_duration in dependencies.items():
+        request_dependency_duration.labels(method, route, dependency).observe(dependency_duration)
+
+
+# /v3/payments/2f4b...-000f-5000-8000-1a2b.../capture -> /v3/payments/{id}/capture
+def yookassa_endpoint(request: httpx.Request) -> str:
+    parts = request.url.path.strip('/').split('/')
+    if len(parts) > 2:
+        parts[2] = '{id}'
+    return f'{request.method} /{'/'.join(parts)}'
+
+
+# Для httpx.AsyncClient(event_hooks=...): длительность запроса до получения заголовков ответа
+def yookassa_event_hooks() -> dict[str, list[Any]]:
+    async def on_request(request: httpx.Request):
+        request.extensions['started'] = time.monotonic()
+
+    async def on_response(response: httpx.Response):
+        if (started := response.request.extensions.get('started')) is not None:
+            duration = time.monotonic() - started
+            yookassa_request_duration.labels(yookassa_endpoint(response.request)).observe(duration)
+            spent('yookassa', duration)
+
+    return {'request': [on_request], 'response': [on_response]}
+
+
+def latest() -> bytes:
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return prometheus_client.generate_latest()
+
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry)
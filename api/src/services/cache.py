@@ -0,0 +1,38 @@
+import time
+from typing import Generic, TypeVar
+from collections import OrderedDict
+
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+# LRU кэш процесса, у каждой записи свой TTL (None - пока не вытеснена)
+class TTLCache(Generic[K, V]):
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict[K, tuple[float | None, V]]()
+
+    def get(self, key: K) -> V | None:
+        if (entry := self._entries.get(key)) is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V, ttl: float | None):
+        self._entries[key] = (time.monotonic() + ttl if ttl is not None else None, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: K):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,253 @@
+import json
+import anyio
+import logging
+import asyncio
+import hashlib
+from uuid import uuid4
+from typing import Any, Awaitable, Callable, Protocol, TypeVar
+from datetime import datetime, timedelta
+from pydantic import TypeAdapter
+from sqlalchemy import select, update, delete, or_, and_, case, null
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import db.postgres
+import tables
+from settings import settings
+from .cache import TTLCache
+
+
+logger = logging.getLogger('idempotency')
+
+
+# Повтор запроса с тем же Idempotency-Key возвращает сохраненный ответ, не выполняя запрос снова:
+# - в процессе - из LRU кэша с TTL (idempotency_cache_*), или дожидается уже выполняющегося запроса
+# - между процессами - через строку idempotency_key: первый запрос вставляет ее и арендует на idempotency_lease_duration,
+#   ответ сохраняется в той же транзакции, что и результат запроса (см. Complete),
+#   а повторы в других процессах ждут сохраненного ответа (или истечения аренды, если первый обработчик упал).
+#   Если аренда истекла и ключ занял другой процесс, ответ сохраняет только он (lease_token):
+#   транзакция опоздавшего откатывается (LeaseLostError), и он ждет сохраненного ответа, как повтор.
+# При ошибке строка удаляется, и повтор выполнит запрос заново.
+# Частичный ответ (Complete с final=False, например пачка с ошибками отдельных платежей) сохраняется без завершения ключа:
+# повтор с тем же ключом получает его в call как previous и доделывает только то, что не удалось
+
+
+class IdempotencyKeyReusedError(Exception):
+    ...
+
+
+# Аренда ключа истекла и перешла другому обработчику
+class LeaseLostError(Exception):
+    ...
+
+
+T = TypeVar('T')
+R = TypeVar('R', contravariant=True)
+
+
+# Сохраняет ответ в транзакции запроса
+class Complete(Protocol[R]):
+    async def __call__(self, session: AsyncSession, response: R, final: bool = True) -> None: ...
+
+
+# Получает Complete и частичный ответ прошлой попытки (или None)
+Call = Callable[[Complete[T], T | None], Awaitable[T]]
+
+
+def fingerprint(params: dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+cache = TTLCache[tuple[str, str], tuple[str, Any]](settings.idempotency_cache_size)
+_in_flight = dict[tuple[str, str], tuple[str, asyncio.Future]]()
+
+
+async def _no_key(session: AsyncSession, response: Any, final: bool = True):
+    pass
+
+
+# call должен вызвать Complete в своей транзакции. Без ключа запрос просто выполняется
+async def run_idempotent(
+    scope: str,
+    key: str | None,
+    request_fingerprint: str,
+    response_type: TypeAdapter[T],
+    call: Call[T]
+) -> T:
+    if key is None:
+        return await call(_no_key, None)
+
+    cache_key = (scope, key)
+    while True:
+        if (cached := cache.get(cache_key)) is not None:
+            cached_fingerprint, cached_response = cached
+            _check_fingerprint(cached_fingerprint, request_fingerprint)
+            return cached_response
+
+        if (in_flight := _in_flight.get(cache_key)) is None:
+            break
+
+        in_flight_fingerprint, future = in_flight
+        _check_fingerprint(in_flight_fingerprint, request_fingerprint)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # Первый запрос отменен (клиент отключился), пробуем выполнить сами
+
+    future = asyncio.get_running_loop().create_future()
+    # Исключение получат только ожидающие повторы, если они есть
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _in_flight[cache_key] = (request_fingerprint, future)
+    try:
+        response, final = await _run_leased(scope, key, request_fingerprint, response_type, call)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(response)
+        if final:
+            cache.put(cache_key, (request_fingerprint, response), settings.idempotency_cache_ttl)
+        return response
+    finally:
+        del _in_flight[cache_key]
+
+
+def _check_fingerprint(stored: str, request_fingerprint: str):
+    if stored != request_fingerprint:
+        raise IdempotencyKeyReusedError()
+
+
+async def _run_leased(
+    scope: str,
+    key: str,
+    request_fingerprint: str,
+    response_type: TypeAdapter[T],
+    call: Call[T]
+) -> tuple[T, bool]:
+    while True:
+        try:
+            return await _run_leased_once(scope, key, request_fingerprint, response_type, call)
+        except LeaseLostError:
+            logger.warning(f'idempotency key lease for {scope} expired before the request completed, waiting for the new holder')
+
+
+async def _run_leased_once(
+    scope: str,
+    key: str,
+    request_fingerprint: str,
+    response_type: TypeAdapter[T],
+    call: Call[T]
+) -> tuple[T, bool]:
+    table = tables.IdempotencyKey
+    where_key = and_(table.scope == scope, table.key == key)
+    lease_token = uuid4()
+
+    while True:
+        now = datetime.now()
+        expired_before = now - timedelta(seconds=settings.idempotency_key_ttl)
+        async with db.postgres.session_maker() as session, session.begin():
+            # Строку можно занять, если ее нет, если она устарела, или если аренда незавершенного запроса истекла.
+            # Частичный ответ продолжает только запрос с теми же параметрами
+            leased = (await session.execute(
+                insert(table)
+                .values({
+                    table.scope: scope,
+                    table.key: key,
+                    table.fingerprint: request_fingerprint,
+                    table.created_at: now,
+                    table.lease_until: now + timedelta(seconds=settings.idempotency_lease_duration),
+                    table.lease_token: lease_token,
+                    table.completed_at: None,
+                    # SQL NULL, а не JSON null - так отличается строка без частичного ответа
+                    table.response: null()
+                })
+                .on_conflict_do_update(
+                    index_elements=[table.scope, table.key],
+                    set_={
+                        'fingerprint': request_fingerprint,
+                        'created_at': now,
+                        'lease_until': now + timedelta(seconds=settings.idempotency_lease_duration),
+                        'lease_token': lease_token,
+                        'completed_at': None,
+                        # Частичный ответ остается для продолжения
+                        'response': case((table.created_at < expired_before, null()), else_=table.response)
+                    },
+                    where=or_(
+                        table.created_at < expired_before,
+                        and_(
+                            table.completed_at.is_(None),
+                            table.lease_until < now,
+                            or_(table.response.is_(None), table.fingerprint == request_fingerprint)
+                        )
+                    )
+                )
+                .returning(table.response)
+            )).one_or_none()
+
+            if leased is None:
+                stored = (await session.execute(
+                    select(table.fingerprint, table.completed_at, table.response)
+                    .where(where_key)
+                )).one_or_none()
+
+        if leased is not None:
+            break
+
+        if stored is not None:
+            _check_fingerprint(stored.fingerprint, request_fingerprint)
+            if stored.completed_at is not None:
+                return response_type.validate_python(stored.response), True
+
+        # Запрос выполняется в другом процессе
+        await asyncio.sleep(settings.idempotency_wait_interval)
+
+    previous = response_type.validate_python(leased.response) if leased.response is not None else None
+    where_leased = and_(where_key, table.lease_token == lease_token, table.completed_at.is_(None))
+    is_final = True
+
+    async def complete(session: AsyncSession, response: T, final: bool = True):
+        nonlocal is_final
+        now = datetime.now()
+        completed = await session.scalar(
+            update(table)
+            .where(where_leased)
+            .values({
+                # Частичный ответ сразу освобождает ключ для повтора
+                table.completed_at: now if final else None,
+                table.lease_until: table.lease_until if final else now,
+                table.response: response_type.dump_python(response, mode='json')
+            })
+            .returning(table.key)
+        )
+        # Исключение откатывает транзакцию запроса вместе с его результатом
+        if completed is None:
+            raise LeaseLostError()
+        is_final = final
+
+    try:
+        return await call(complete, previous), is_final
+    except LeaseLostError:
+        raise
+    except BaseException:
+        # Освобождаем ключ для повтора, даже если запрос отменен.
+        # Строку с частичным ответом не удаляем, а только снимаем аренду: в ней то, что уже сделано
+        with anyio.CancelScope(shield=True):
+            async with db.postgres.session_maker() as session, session.begin():
+                await session.execute(delete(table).where(where_leased, table.response.is_(None)))
+                await session.execute(update(table).where(where_leased).values({table.lease_until: datetime.now()}))
+        raise
+
+
+async def purge_expired_keys() -> int:
+    async with db.postgres.session_maker() as session, session.begin():
+        return len((await session.execute(
+            delete(tables.IdempotencyKey)
+            .where(tables.IdempotencyKey.created_at < datetime.now() - timedelta(seconds=settings.idempotency_key_ttl))
+            .returning(tables.IdempotencyKey.key)
+        )).all())
+
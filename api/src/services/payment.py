@@ -1,17 +1,23 @@
 import httpx
+import anyio
 import logging
 from typing import Any
 from functools import lru_cache
 from datetime import datetime
-from uuid import UUID, uuid4
+from uuid import UUID, uuid4, uuid5, NAMESPACE_URL
 from decimal import Decimal
-from dataclasses import dataclass
-from pydantic import BaseModel, HttpUrl
-from sqlalchemy import insert
+from dataclasses import dataclass, asdict
+from pydantic import BaseModel, HttpUrl, TypeAdapter
+from sqlalchemy import Uuid, insert, select, update, any_, bindparam, or_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import db.postgres
 import tables
-from settings import yookassa_settings
+import metrics
+import tracing
+from settings import settings, yookassa_settings
+from .idempotency import Complete, fingerprint, run_idempotent
 
 
 logger = logging.getLogger('payment-service')
@@ -25,11 +31,68 @@ class ExternalPaymentServiceError(Exception):
     ...
 
 
+# Запрос платежа сейчас обрабатывает воркер, уведомление нужно повторить позже
+class PaymentRequestInProgressError(Exception):
+    ...
+
+
 class ChargeInfo(BaseModel):
     payment_id: UUID
     confirmation_url: HttpUrl | None
 
 
+# Элемент ответа POST /api/v1/payment/batch: платеж, или ошибка его создания
+class PaymentBatchItem(BaseModel):
+    payment: ChargeInfo | None
+    error: str | None
+
+
+@dataclass(frozen=True)
+class PaymentParams:
+    user_id: UUID
+    handler_url: str | None
+    handler_batching: bool
+    return_url: str
+    amount: Decimal
+    currency: str
+    extra_data: dict[str, Any] | None
+    card_data: dict[str, Any] | None
+
+
+@dataclass(frozen=True)
+class RefundParams:
+    payment_id: UUID
+    handler_url: str | None
+    handler_batching: bool
+    amount: Decimal
+    currency: str
+    extra_data: dict[str, Any] | None
+
+
+# Элемент ответа POST /api/v1/refund/batch: id созданного возврата, или ошибка
+class RefundBatchItem(BaseModel):
+    refund_id: UUID | None
+    error: str | None
+
+
+@dataclass(frozen=True)
+class _CreatedPayment:
+    params: PaymentParams
+    charge_info: ChargeInfo
+    external_id: str
+
+
+_charge_info_type = TypeAdapter(ChargeInfo)
+_payment_batch_type = TypeAdapter(list[PaymentBatchItem])
+_refund_batch_type = TypeAdapter(list[RefundBatchItem])
+_no_response_type: TypeAdapter[None] = TypeAdapter(None)
+
+
+# С тем же ключом и Yookassa не создаст второй платеж, даже если ответ на первый запрос потерялся
+def yookassa_idempotence_key(idempotency_key: str | None, name: str) -> str:
+    return str(uuid5(NAMESPACE_URL, f'{name}:{idempotency_key}') if idempotency_key is not None else uuid4())
+
+
 @dataclass(frozen=True)
 class PaymentService:
     yookassa_client: httpx.AsyncClient
@@ -38,41 +101,112 @@ class PaymentService:
         self,
         user_id: UUID,
         handler_url: str | None,
+        handler_batching: bool,
         return_url: str,
         amount: Decimal,
         currency: str,
         extra_data: dict[str, Any] | None,
-        card_data: dict[str, Any] | None
-    ):
-        payment_id = uuid4()
+        card_data: dict[str, Any] | None,
+        idempotency_key: str | None = None
+    ) -> ChargeInfo:
+        params = PaymentParams(
+            user_id=user_id,
+            handler_url=handler_url,
+            handler_batching=handler_batching,
+            return_url=return_url,
+            amount=amount,
+            currency=currency,
+            extra_data=extra_data,
+            card_data=card_data
+        )
+        request_fingerprint = fingerprint(asdict(params))
+        key = yookassa_idempotence_key(idempotency_key, f'payment:{request_fingerprint}')
+
+        async def create(complete: Complete[ChargeInfo], previous: ChargeInfo | None) -> ChargeInfo:
+            created = await self._create_external_payment(key, params)
+            async with db.postgres.session_maker() as session, session.begin():
+                await self._save_payments(session, [created])
+                await complete(session, created.charge_info)
+            return created.charge_info
+
+        return await run_idempotent('payment', idempotency_key, request_fingerprint, _charge_info_type, create)
+
+    # Платежи в Yookassa создаются параллельно (не больше payment_batch_concurrency запросов),
+    # а сохраняются одной транзакцией, по одному запросу на таблицу. Ответ - в порядке items.
+    # Не успевшие за payment_batch_timeout платежи возвращаются с ошибкой. Ответ с ошибками сохраняется как частичный:
+    # повтор с тем же Idempotency-Key создает только их (с теми же ключами Yookassa), созданные остаются в ответе
+    async def payments(self, items: list[PaymentParams], idempotency_key: str | None = None) -> list[PaymentBatchItem]:
+        request_fingerprint = fingerprint({'items': [asdict(params) for params in items]})
+
+        async def create(
+            complete: Complete[list[PaymentBatchItem]],
+            previous: list[PaymentBatchItem] | None
+        ) -> list[PaymentBatchItem]:
+            created = dict[int, _CreatedPayment]()
+            errors = dict[int, str]()
+            limiter = anyio.CapacityLimiter(settings.payment_batch_concurrency)
 
+            async def create_one(index: int, params: PaymentParams):
+                key = yookassa_idempotence_key(idempotency_key, f'payment_batch:{request_fingerprint}:{index}')
+                async with limiter:
+                    try:
+                        created[index] = await self._create_external_payment(key, params)
+                    except ExternalPaymentServiceError:
+                        errors[index] = 'external payment service error'
+                    except Exception:
+                        # Ошибка одного платежа не должна терять уже созданные
+                        logger.exception(f'failed to create payment {index} of batch')
+                        errors[index] = 'internal error'
+
+            results = previous or [PaymentBatchItem(payment=None, error=None) for _ in items]
+            pending = [index for index, item in enumerate(results) if item.payment is None]
+            with anyio.move_on_after(settings.payment_batch_timeout):
+                async with anyio.create_task_group() as tg:
+                    for index in pending:
+                        tg.start_soon(create_one, index, items[index])
+
+            for index in pending:
+                results[index] = (
+                    PaymentBatchItem(payment=created[index].charge_info, error=None) if index in created else
+                    PaymentBatchItem(payment=None, error=errors.get(index, 'timeout'))
+                )
+
+            async with db.postgres.session_maker() as session, session.begin():
+                await self._save_payments(session, list(created.values()))
+                await complete(session, results, final=all(item.payment is not None for item in results))
+            return results
+
+        return await run_idempotent('payment_batch', idempotency_key, request_fingerprint, _payment_batch_type, create)
+
+    async def _create_external_payment(self, idempotence_key: str, params: PaymentParams) -> _CreatedPayment:
         # https://yookassa.ru/developers/api#create_payment
         try:
-            response = await self.yookassa_client.post(
-                url='/v3/payments',
-                headers={'Idempotence-Key': str(uuid4())},
-                json={
-                    'amount': {
-                        'value': str(amount),
-                        'currency': currency
-                    },
-                    'confirmation': {
-                        'type': 'redirect',
-                        'return_url': str(return_url)
-                    },
-                    # https://yookassa.ru/developers/payment-acceptance/getting-started/payment-process#capture-and-cancel
-                    'capture': True
-                } | (
-                    {
-                        'payment_method_data': {
-                            'type': 'bank_card',
-                            'card': card_data
-                        }
-                    } or {}
+            with tracing.span('yookassa', endpoint='POST /v3/payments'):
+                response = await self.yookassa_client.post(
+                    url='/v3/payments',
+                    headers={'Idempotence-Key': idempotence_key},
+                    json={
+                        'amount': {
+                            'value': str(params.amount),
+                            'currency': params.currency
+                        },
+                        'confirmation': {
+                            'type': 'redirect',
+                            'return_url': str(params.return_url)
+                        },
+                        # https://yookassa.ru/developers/payment-acceptance/getting-started/payment-process#capture-and-cancel
+                        'capture': True
+                    } | (
+                        {
+                            'payment_method_data': {
+                                'type': 'bank_card',
+                                'card': params.card_data
+                            }
+                        } or {}
+                    )
                 )
-            )
-        except httpx.ConnectError as e:
-            logger.error(f'connection error: {str(e)}')
+        except httpx.HTTPError as e:
+            logger.error(f'yookassa request error: {str(e)}')
             raise ExternalPaymentServiceError()
 
         if response.status_code != 200:
@@ -85,72 +219,193 @@ class PaymentService:
         # https://yookassa.ru/developers/payment-acceptance/getting-started/payment-process#user-confirmation
 
         response_json = response.json()
+        return _CreatedPayment(
+            params=params,
+            charge_info=ChargeInfo(
+                payment_id=uuid4(),
+                confirmation_url=(
+                    HttpUrl(response_json['confirmation']['confirmation_url'])
+                    if not params.card_data else None
+                )
+            ),
+            external_id=response_json['id']
+        )
+
+    async def _save_payments(self, session: AsyncSession, created: list[_CreatedPayment]):
+        if not created:
+            return
+
         now = datetime.now()
+        trace_id = tracing.current_trace_id()
 
-        async with db.postgres.session_maker() as session, session.begin():
-            await session.execute(insert(tables.Payment).values({
-                tables.Payment.id: payment_id,
-                tables.Payment.external_id: response_json['id'],
-                tables.Payment.user_id: user_id,
-                tables.Payment.status: 'created',
-                tables.Payment.external_cancellation_reason: None,
-                tables.Payment.created_at: now,
-                tables.Payment.amount: amount,
-                tables.Payment.currency: currency,
-            }))
-
-            await session.execute(insert(tables.PaymentRequest).values({
-                tables.PaymentRequest.id: uuid4(),
-                tables.PaymentRequest.created_at: now,
-                tables.PaymentRequest.payment_id: payment_id,
-                tables.PaymentRequest.handler_url: handler_url,
-                tables.PaymentRequest.extra_data: extra_data
-            }))
-
-        return ChargeInfo(
-            payment_id=payment_id,
-            confirmation_url=(
-                HttpUrl(response_json['confirmation']['confirmation_url'])
-                if not card_data else None
-            )
-        )
+        await session.execute(insert(tables.Payment).values([
+            {
+                'id': c.charge_info.payment_id,
+                'external_id': c.external_id,
+                'user_id': c.params.user_id,
+                'status': 'created',
+                'external_cancellation_reason': None,
+                'created_at': now,
+                'amount': c.params.amount,
+                'currency': c.params.currency
+            }
+            for c in created
+        ]))
+
+        await session.execute(insert(tables.PaymentRequest).values([
+            {
+                'id': uuid4(),
+                'created_at': now,
+                'next_attempt_at': now,
+                'attempts': 0,
+                'payment_id': c.charge_info.payment_id,
+                'handler_url': c.params.handler_url,
+                'handler_batching': c.params.handler_batching,
+                'trace_id': trace_id,
+                'extra_data': c.params.extra_data
+            }
+            for c in created
+        ]))
+
+        await db.postgres.notify(session, tables.PaymentRequest.__tablename__)
 
     async def refund(
         self,
         payment_id: UUID,
         handler_url: str | None,
+        handler_batching: bool,
         amount: Decimal,
         currency: str,
-        extra_data: dict[str, Any] | None
+        extra_data: dict[str, Any] | None,
+        idempotency_key: str | None = None
     ):
+        params = RefundParams(
+            payment_id=payment_id,
+            handler_url=handler_url,
+            handler_batching=handler_batching,
+            amount=amount,
+            currency=currency,
+            extra_data=extra_data
+        )
+
         # Мы могли бы сразу отправить post запрос на yookassa, и ответ вернуть клиенту
         # Но у yookassa после выполнения refund на своей стороне могут возникнуть проблемы при возврате ответа
+        async def create(complete: Complete[None], previous: None):
+            async with db.postgres.session_maker() as session, session.begin():
+                payment = await session.get(tables.Payment, payment_id)
+                if payment is None:
+                    raise PaymentDoesntExistError()
+
+                await self._save_refunds(session, [(uuid4(), params)])
+                await complete(session, None)
+
+        await run_idempotent('refund', idempotency_key, fingerprint(asdict(params)), _no_response_type, create)
+
+    # Существование всех платежей проверяется одним запросом, возвраты сохраняются по одному запросу на таблицу.
+    # Ответ - в порядке items
+    async def refunds(self, items: list[RefundParams], idempotency_key: str | None = None) -> list[RefundBatchItem]:
+        async def create(
+            complete: Complete[list[RefundBatchItem]],
+            previous: list[RefundBatchItem] | None
+        ) -> list[RefundBatchItem]:
+            async with db.postgres.session_maker() as session, session.begin():
+                existing = set((await session.scalars(
+                    select(tables.Payment.id)
+                    .where(tables.Payment.id == any_(
+                        bindparam('payment_ids', list({params.payment_id for params in items}), type_=ARRAY(Uuid))
+                    ))
+                )).all())
+
+                refund_ids = [uuid4() if params.payment_id in existing else None for params in items]
+                await self._save_refunds(session, [
+                    (refund_id, params)
+                    for refund_id, params in zip(refund_ids, items)
+                    if refund_id is not None
+                ])
+
+                results = [
+                    RefundBatchItem(refund_id=refund_id, error=None)
+                    if refund_id is not None else
+                    RefundBatchItem(refund_id=None, error='payment with such id doesn\'t exist')
+                    for refund_id in refund_ids
+                ]
+                await complete(session, results)
+
+            return results
+
+        request_fingerprint = fingerprint({'items': [asdict(params) for params in items]})
+        return await run_idempotent('refund_batch', idempotency_key, request_fingerprint, _refund_batch_type, create)
+
+    async def _save_refunds(self, session: AsyncSession, refunds: list[tuple[UUID, RefundParams]]):
+        if not refunds:
+            return
+
+        now = datetime.now()
+        trace_id = tracing.current_trace_id()
+
+        # Строки передаются отдельно от insert: SQLAlchemy (insertmanyvalues) разбивает их на многострочные INSERT
+        # по 1000 строк, не упираясь в ограничение postgres на число параметров запроса
+        await session.execute(insert(tables.Refund), [
+            {
+                'id': refund_id,
+                'external_id': None,
+                'payment_id': params.payment_id,
+                'created_at': now,
+                'status': 'created',
+                'external_cancellation_reason': None,
+                'amount': params.amount,
+                'currency': params.currency
+            }
+            for refund_id, params in refunds
+        ])
+
+        await session.execute(insert(tables.RefundRequest), [
+            {
+                'id': uuid4(),
+                'created_at': now,
+                'next_attempt_at': now,
+                'attempts': 0,
+                'refund_id': refund_id,
+                'handler_url': params.handler_url,
+                'handler_batching': params.handler_batching,
+                'trace_id': trace_id,
+                'extra_data': params.extra_data
+            }
+            for refund_id, params in refunds
+        ])
+
+        await db.postgres.notify(session, tables.RefundRequest.__tablename__)
+
+    # Уведомлениям (веб-хук Yookassa) не доверяем: они не подписаны.
+    # Только переводим запрос платежа в начало очереди, и воркер сам проверит статус платежа.
+    # Арендованный запрос не трогаем (иначе его заберет второй воркер, не дожидаясь конца аренды):
+    # воркер мог успеть получить от Yookassa еще незавершенный статус, поэтому уведомление нужно повторить
+    async def external_payment_notification(self, external_id: str) -> bool:
+        now = datetime.now()
+        where_payment = tables.PaymentRequest.payment_id.in_(
+            select(tables.Payment.id)
+            .where(tables.Payment.external_id == external_id)
+        )
+
         async with db.postgres.session_maker() as session, session.begin():
-            payment = await session.get(tables.Payment, payment_id)
-            if payment is None:
-                raise PaymentDoesntExistError()
-
-            refund_id = uuid4()
-            now = datetime.now()
-
-            await session.execute(insert(tables.Refund).values({
-                tables.Refund.id: refund_id,
-                tables.Refund.external_id: None,
-                tables.Refund.payment_id: payment_id,
-                tables.Refund.created_at: now,
-                tables.Refund.status: 'created',
-                tables.Refund.external_cancellation_reason: None,
-                tables.Refund.amount: amount,
-                tables.Refund.currency: currency
-            }))
-
-            await session.execute(insert(tables.RefundRequest).values({
-                tables.RefundRequest.id: uuid4(),
-                tables.RefundRequest.created_at: now,
-                tables.RefundRequest.refund_id: refund_id,
-                tables.RefundRequest.handler_url: handler_url,
-                tables.RefundRequest.extra_data: extra_data
-            }))
+            request_id = await session.scalar(
+                update(tables.PaymentRequest)
+                .where(where_payment, or_(
+                    tables.PaymentRequest.claimed_by.is_(None),
+                    tables.PaymentRequest.lease_until < now
+                ))
+                .values({tables.PaymentRequest.next_attempt_at: now})
+                .returning(tables.PaymentRequest.id)
+            )
+
+            if request_id is None:
+                if await session.scalar(select(tables.PaymentRequest.id).where(where_payment)) is not None:
+                    raise PaymentRequestInProgressError()
+                return False
+
+            await db.postgres.notify(session, tables.PaymentRequest.__tablename__)
+
+        return True
 
 
 @lru_cache
@@ -159,6 +414,7 @@ def get_payment_service() -> PaymentService:
         yookassa_client=httpx.AsyncClient(
             base_url=yookassa_settings.base_url,
             auth=httpx.BasicAuth(yookassa_settings.shop_id, yookassa_settings.secret_key),
-            timeout=yookassa_settings.connection_timeout_sec
+            timeout=yookassa_settings.connection_timeout_sec,
+            event_hooks=metrics.yookassa_event_hooks()
         )
     )
\ No newline at end of file
@@ -0,0 +1,185 @@
+import anyio
+import asyncio
+import hashlib
+import orjson
+from uuid import UUID
+from decimal import Decimal
+from datetime import datetime
+from dataclasses import dataclass
+from typing import Literal
+from pydantic import BaseModel
+from sqlalchemy import Select, select
+
+import db.postgres
+import db.listener
+import tables
+from settings import settings
+from .cache import TTLCache
+
+
+# Статусы платежей и возвратов для GET /api/v1/payment/{id} и /api/v1/refund/{id}.
+# Ответы (уже сериализованные, с ETag) кэшируются в процессе: завершенные (succeeded/cancelled) - без TTL,
+# остальные - на status_cache_ttl. Воркер, меняя статус, уведомляет через NOTIFY на канал с именем таблицы
+# (payload - id), и каждый процесс API удаляет запись из своего кэша (см. listener).
+# Одновременные чтения одного статуса из базы объединяются в одно, поэтому ожидающие (wait_payment_status),
+# разбуженные уведомлением, делают один запрос на процесс
+
+
+class PaymentInfo(BaseModel):
+    id: UUID
+    status: tables.payment.Status
+    external_cancellation_reason: str | None
+    created_at: datetime
+    amount: Decimal
+    currency: str
+
+
+class RefundInfo(BaseModel):
+    id: UUID
+    payment_id: UUID
+    status: tables.refund.Status
+    external_cancellation_reason: str | None
+    created_at: datetime
+    amount: Decimal
+    currency: str
+
+
+@dataclass(frozen=True)
+class Status:
+    body: bytes
+    etag: str
+    terminal: bool  # succeeded или cancelled, больше не изменится
+
+
+Kind = Literal['payment', 'refund']
+
+_caches = {
+    'payment': TTLCache[UUID, Status](settings.status_cache_size),
+    'refund': TTLCache[UUID, Status](settings.status_cache_size)
+}
+# Растет при каждой инвалидации: ответ, прочитанный до нее, не кладется в кэш
+_generations = {'payment': 0, 'refund': 0}
+_loading = dict[tuple[Kind, UUID], asyncio.Future[Status | None]]()
+_waiters = dict[UUID, set[asyncio.Event]]()
+
+
+async def payment_status(payment_id: UUID) -> Status | None:
+    return await _status('payment', payment_id, (
+        select(tables.Payment).where(tables.Payment.id == payment_id)
+    ), PaymentInfo)
+
+
+async def refund_status(refund_id: UUID) -> Status | None:
+    return await _status('refund', refund_id, (
+        select(tables.Refund).where(tables.Refund.id == refund_id)
+    ), RefundInfo)
+
+
+async def _status(
+    kind: Kind,
+    id: UUID,
+    query: Select[tuple[tables.Payment]] | Select[tuple[tables.Refund]],
+    info_type: type[PaymentInfo] | type[RefundInfo]
+) -> Status | None:
+    cache = _caches[kind]
+    while True:
+        if (status := cache.get(id)) is not None:
+            return status
+
+        if (loading := _loading.get((kind, id))) is None:
+            break
+
+        try:
+            return await asyncio.shield(loading)
+        except asyncio.CancelledError:
+            if not loading.cancelled():
+                raise
+            # Отменен запрос, который читал статус (клиент отключился или истек timeout ожидания), а не этот - читаем сами
+
+    future = _loading[kind, id] = asyncio.get_running_loop().create_future()
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        status = await _load(kind, id, query, info_type)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(status)
+        return status
+    finally:
+        del _loading[kind, id]
+
+
+async def _load(
+    kind: Kind,
+    id: UUID,
+    query: Select[tuple[tables.Payment]] | Select[tuple[tables.Refund]],
+    info_type: type[PaymentInfo] | type[RefundInfo]
+) -> Status | None:
+    generation = _generations[kind]
+    async with db.postgres.session_maker() as session:
+        row = await session.scalar(query)
+    if row is None:
+        return None
+
+    body = orjson.dumps(info_type.model_validate(row, from_attributes=True).model_dump(mode='json'))
+    status = Status(
+        body=body,
+        etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        terminal=row.status in ('succeeded', 'cancelled')
+    )
+
+    if _generations[kind] == generation:
+        _caches[kind].put(id, status, None if status.terminal else settings.status_cache_ttl)
+    return status
+
+
+# Ждет, пока платеж не завершится (или timeout), и возвращает его статус.
+# Ожидание не делает запросов в базу: ожидающих будит уведомление воркера, полученное общим listener процесса
+async def wait_payment_status(payment_id: UUID, timeout: float) -> Status | None:
+    event = asyncio.Event()
+    _waiters.setdefault(payment_id, set()).add(event)
+    try:
+        with anyio.move_on_after(timeout):
+            while True:
+                # Подписка раньше чтения: уведомление между ними не потеряется
+                event.clear()
+                status = await payment_status(payment_id)
+                if status is None or status.terminal:
+                    return status
+                await event.wait()
+    finally:
+        waiters = _waiters[payment_id]
+        waiters.discard(event)
+        if not waiters:
+            del _waiters[payment_id]
+
+    return await payment_status(payment_id)
+
+
+def invalidate(kind: Kind, payload: str):
+    _generations[kind] += 1
+    # Пустой payload - слушатель переподключился и мог пропустить уведомления
+    if not payload:
+        _caches[kind].clear()
+        if kind == 'payment':
+            for waiters in _waiters.values():
+                for event in waiters:
+                    event.set()
+        return
+
+    for id in map(UUID, payload.split(',')):
+        _caches[kind].pop(id)
+        if kind == 'payment':
+            for event in _waiters.get(id, ()):
+                event.set()
+
+
+def listener() -> db.listener.Listener:
+    listener = db.listener.Listener([tables.Payment.__tablename__, tables.Refund.__tablename__])
+    listener.subscribe(tables.Payment.__tablename__, lambda payload: invalidate('payment', payload))
+    listener.subscribe(tables.Refund.__tablename__, lambda payload: invalidate('refund', payload))
+    return listener
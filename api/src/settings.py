@@ -1,19 +1,163 @@
+import random
+from typing import Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import Field
+from pydantic import BaseModel, Field, ValidationInfo, field_validator, model_validator
+
+
+class BackoffPolicy(BaseModel):
+    base: float = Field(gt=0.0)
+    multiplier: float = Field(default=2.0, ge=1.0)
+    cap: float = Field(gt=0.0)
+    jitter: float = Field(default=0.1, ge=0.0, le=1.0)  # Доля от задержки
+
+    def delay(self, attempts: int) -> float:
+        delay = min(self.cap, self.base * self.multiplier ** max(attempts - 1, 0))
+        return delay * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+
+# Интервал опроса в зависимости от возраста: initial первые initial_period секунд,
+# затем доля ratio от возраста (но не меньше initial и не больше cap)
+class PollingCurve(BaseModel):
+    initial: float = Field(gt=0.0)
+    initial_period: float = Field(ge=0.0)
+    ratio: float = Field(gt=0.0)
+    cap: float = Field(gt=0.0)
+    jitter: float = Field(default=0.1, ge=0.0, le=1.0)  # Доля от задержки
+
+    def delay(self, age: float) -> float:
+        delay = self.initial if age < self.initial_period else min(self.cap, max(self.initial, age * self.ratio))
+        return delay * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+
+# Конкурентность цикла воркера меняется в границах [min, max] (см. worker.pool.WorkerPool):
+# растет на increase_step, пока очередь не успевает разбираться,
+# и уменьшается в decrease_factor раз, если p95 длительности обработки выше latency_target или ошибок больше error_rate_limit
+class ConcurrencyPolicy(BaseModel):
+    min: int = Field(default=1, gt=0)
+    max: int = Field(gt=0)
+    latency_target: float = Field(gt=0.0)
+    error_rate_limit: float = Field(default=0.2, ge=0.0, le=1.0)
+    increase_step: int = Field(default=1, gt=0)
+    decrease_factor: float = Field(default=0.5, gt=0.0, lt=1.0)
+
+    def capped(self, limit: int) -> 'ConcurrencyPolicy':
+        return self.model_copy(update={'max': limit, 'min': min(self.min, limit)})
 
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file='.env.local', extra='allow', env_prefix='bill_api_')
 
+    # Должна быть больше самого долгого внешнего запроса (см. YookassaSettings.connection_timeout_sec)
+    worker_lease_duration: float = Field(default=120.0)
+    worker_steal_delay: float = Field(default=10.0)  # См. worker.lease.Partition
+    worker_restart_delay: float = Field(default=1.0)
+    worker_concurrency_adjust_interval: float = Field(default=5.0)
+    worker_metrics_port: int | None = Field(default=9108)  # None - не отдавать метрики
+    worker_metrics_sample_interval: float = Field(default=15.0)
+    # См. worker.lanes
+    worker_early_retry_attempts: int = Field(default=3, gt=0)
+    worker_first_attempt_lane_weight: int = Field(default=6, ge=0)
+    worker_early_retry_lane_weight: int = Field(default=3, ge=0)
+    worker_long_tail_lane_weight: int = Field(default=1, ge=0)
+
+    # Интервал запасного опроса очереди, если уведомление о новом запросе (LISTEN/NOTIFY) было пропущено
     refund_loop_sleep_duration: float = Field(default=3.0)
-    refund_loop_concurrency: int = Field(default=1)
+    refund_loop_concurrency: ConcurrencyPolicy = Field(default=ConcurrencyPolicy(max=8, latency_target=10.0))
+    refund_loop_backoff: BackoffPolicy = Field(default=BackoffPolicy(base=3.0, cap=300.0))
 
     payments_polling_loop_sleep_duration: float = Field(default=3.0)
-    payments_polling_loop_concurrency: int = Field(default=1)
+    payments_polling_loop_concurrency: ConcurrencyPolicy = Field(default=ConcurrencyPolicy(max=16, latency_target=5.0))
+    payments_polling_loop_batch_size: int = Field(default=20, gt=0)
+    # Большинство платежей завершается в первые минуты, брошенные - проверяются все реже,
+    # и один раз сразу после payments_confirmation_expiry (когда Yookassa отменяет неподтвержденный платеж)
+    payments_polling_curve: PollingCurve = Field(default=PollingCurve(initial=3.0, initial_period=60.0, ratio=0.25, cap=600.0))
+    # https://yookassa.ru/developers/payment-acceptance/after-the-payment/declined-payments#expired-on-confirmation
+    payments_confirmation_expiry: float = Field(default=60 * 60.0)
+    payments_confirmation_expiry_margin: float = Field(default=30.0)
+
+    # При включенном веб-хуке Yookassa (/api/v1/yookassa/notifications) опрос платежей нужен только
+    # для сверки на случай потерянных уведомлений, и вместо payments_polling_curve используется более редкий
+    yookassa_webhook_enabled: bool = Field(default=False)
+    payments_reconciliation_backoff: BackoffPolicy = Field(default=BackoffPolicy(base=60.0, cap=30 * 60.0))
+
+    # При включении стоит сделать реже payments_polling_curve - запросы по отдельным платежам станут запасным вариантом
+    payments_list_resolution_enabled: bool = Field(default=False)
+    payments_list_resolution_interval: float = Field(default=5.0)
+    payments_list_resolution_max_age: float = Field(default=24 * 60 * 60)  # Для первого просмотра после запуска
+    payments_list_resolution_lookback: float = Field(default=10 * 60.0)
+    payments_list_resolution_margin: float = Field(default=60.0)
 
     handlers_notification_loop_sleep_duration: float = Field(default=3.0)
-    handlers_notification_loop_concurrency: int = Field(default=1)
+    # Длительность задачи - только аренда, отправки идут в фоне (см. worker.notify_handlers), но цель все равно выше таймаута
+    handlers_notification_loop_concurrency: ConcurrencyPolicy = Field(default=ConcurrencyPolicy(max=16, latency_target=10.0))
+    handlers_notification_loop_batch_size: int = Field(default=50, gt=0)
+    handlers_notification_loop_backoff: BackoffPolicy = Field(default=BackoffPolicy(base=3.0, cap=600.0))
     handler_notification_timeout: float = Field(default=5.0)
+    # Лимиты на одного адресата (host:port) обработчиков
+    handler_destination_concurrency: int = Field(default=4, gt=0)
+    handler_destination_keepalive_expiry: float = Field(default=60.0)
+    handler_http2: bool = Field(default=False)  # Только если установлен пакет h2 (httpx[http2])
+    # Уведомления с handler_batching копятся handler_batch_window секунд (или до handler_batch_max_size штук)
+    # и отправляются на handler_url одним массивом
+    handler_batch_window: float = Field(default=5.0)
+    handler_batch_max_size: int = Field(default=100, gt=0)
+    handler_breaker_failure_threshold: int = Field(default=5, gt=0)
+    handler_breaker_open_duration: float = Field(default=30.0)
+    # После этого уведомление переносится в dead letters (см. `python -m admin requeue-dead-letters`)
+    handler_notification_max_attempts: int = Field(default=50, gt=0)
+    handler_notification_max_age: float = Field(default=3 * 24 * 60 * 60)
+
+    outbox_relay_sleep_duration: float = Field(default=3.0)
+    outbox_relay_batch_size: int = Field(default=500, gt=0)
+    outbox_relay_backoff: BackoffPolicy = Field(default=BackoffPolicy(base=1.0, cap=60.0))
+
+    # POST /api/v1/payment/batch: число платежей в запросе и одновременных запросов к Yookassa.
+    # Пачка должна успевать за payment_batch_timeout: max_size / concurrency запросов подряд
+    payment_batch_max_size: int = Field(default=100, gt=0)
+    payment_batch_concurrency: int = Field(default=16, gt=0)
+    # Меньше proxy_read_timeout nginx (60 секунд) и idempotency_lease_duration, не успевшие платежи возвращаются с ошибкой
+    payment_batch_timeout: float = Field(default=45.0, gt=0.0)
+    refund_batch_max_size: int = Field(default=10000, gt=0)  # POST /api/v1/refund/batch
+
+    # См. services.status. Завершенные платежи и возвраты кэшируются без TTL
+    status_cache_size: int = Field(default=100000, gt=0)
+    status_cache_ttl: float = Field(default=5.0)
+    # GET /api/v1/payment/{id}/wait. Меньше proxy_read_timeout nginx (60 секунд по умолчанию)
+    payment_wait_max_timeout: float = Field(default=55.0, gt=0.0)
+
+    # См. services.idempotency. Yookassa хранит ключи идемпотентности сутки
+    idempotency_key_ttl: float = Field(default=24 * 60 * 60)
+    idempotency_cache_size: int = Field(default=10000, gt=0)
+    idempotency_cache_ttl: float = Field(default=10 * 60.0)
+    # Должна быть больше самого долгого запроса к Yookassa (см. YookassaSettings.connection_timeout_sec)
+    idempotency_lease_duration: float = Field(default=90.0)
+    idempotency_wait_interval: float = Field(default=0.05)
+
+    # См. tracing. Для своего экспортера - tracing.exporter
+    tracing_exporter: Literal['none', 'stdout', 'file'] = Field(default='none')
+    tracing_file_path: str = Field(default='traces.jsonl')
+
+    # Раньше *_concurrency были числом: число задает max, остальное - из значения по умолчанию
+    @field_validator(
+        'refund_loop_concurrency',
+        'payments_polling_loop_concurrency',
+        'handlers_notification_loop_concurrency',
+        mode='before'
+    )
+    @classmethod
+    def concurrency_from_int(cls, value: object, info: ValidationInfo) -> object:
+        if isinstance(value, int) and not isinstance(value, bool):
+            assert info.field_name is not None
+            default = cls.model_fields[info.field_name].default
+            return default.model_dump() | {'max': value, 'min': min(default.min, value)}
+        return value
+
+    # Иначе повтор пачки займет ключ идемпотентности, пока первый запрос еще создает платежи
+    @model_validator(mode='after')
+    def check_payment_batch_timeout(self) -> 'Settings':
+        if self.payment_batch_timeout >= self.idempotency_lease_duration:
+            raise ValueError('payment_batch_timeout must be less than idempotency_lease_duration')
+        return self
 
 
 class PostgresSettings(BaseSettings):
@@ -35,6 +179,15 @@ class KafkaSettings(BaseSettings):
 
     bootstrap_servers: str = Field(default='localhost:19092')
 
+    # https://aiokafka.readthedocs.io/en/stable/api.html#producer-class
+    # lz4, snappy и zstd требуют установки дополнительных пакетов, gzip - нет
+    compression_type: Literal['gzip', 'snappy', 'lz4', 'zstd'] | None = Field(default='gzip')
+    linger_ms: int = Field(default=20, ge=0)
+    max_batch_size: int = Field(default=256 * 1024, gt=0)
+    max_request_size: int = Field(default=1024 * 1024, gt=0)
+    acks: Literal['all'] | int = Field(default=1)
+    request_timeout_ms: int = Field(default=40000, gt=0)
+
 
 class YookassaSettings(BaseSettings):
     model_config = SettingsConfigDict(env_file='.env.local', extra='allow', env_prefix='bill_yookassa_')
@@ -3,4 +3,7 @@ from .payment import Payment  # noqa
 from .refund import Refund  # noqa
 from .refund_request import RefundRequest  # noqa
 from .payment_request import PaymentRequest  # noqa
-from .notify_handler_request import HandlerNotificationRequest  # noqa
\ No newline at end of file
+from .notify_handler_request import HandlerNotificationRequest  # noqa
+from .outbox import OutboxMessage  # noqa
+from .handler_notification_dead_letter import HandlerNotificationDeadLetter  # noqa
+from .idempotency_key import IdempotencyKey  # noqa
\ No newline at end of file
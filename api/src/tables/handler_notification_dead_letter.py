@@ -0,0 +1,22 @@
+from uuid import UUID
+from datetime import datetime
+from typing import Any
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+# Уведомления, которые не удалось доставить за отведенное число попыток или время
+class HandlerNotificationDeadLetter(Base):
+    __tablename__ = 'handler_notification_dead_letter'
+
+    id: Mapped[UUID] = mapped_column(primary_key=True)
+    created_at: Mapped[datetime] = mapped_column()
+    failed_at: Mapped[datetime] = mapped_column(index=True)
+    attempts: Mapped[int] = mapped_column()
+    last_error: Mapped[str | None] = mapped_column(nullable=True)
+    handler_url: Mapped[str] = mapped_column(index=True)
+    handler_host: Mapped[str] = mapped_column()
+    batching: Mapped[bool] = mapped_column()
+    trace_id: Mapped[str | None] = mapped_column(nullable=True)  # См. tracing
+    data: Mapped[dict[str, Any]] = mapped_column()
@@ -0,0 +1,20 @@
+from uuid import UUID
+from datetime import datetime
+from typing import Any
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+# Ключи идемпотентности (заголовок Idempotency-Key) и сохраненные ответы, см. services.idempotency
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_key'
+
+    scope: Mapped[str] = mapped_column(primary_key=True)  # Метод API: payment, refund
+    key: Mapped[str] = mapped_column(primary_key=True)
+    fingerprint: Mapped[str] = mapped_column()  # Хэш параметров запроса
+    created_at: Mapped[datetime] = mapped_column(index=True)
+    lease_until: Mapped[datetime] = mapped_column()  # До этого времени запрос выполняется первым обработчиком
+    lease_token: Mapped[UUID] = mapped_column()  # Новый при каждой аренде: ответ сохраняет только текущий арендатор
+    completed_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    response: Mapped[dict[str, Any] | None] = mapped_column(nullable=True)
@@ -2,15 +2,31 @@ from uuid import UUID
 from datetime import datetime
 from typing import Any
 from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import Index, text
 
 from .base import Base
 
 
 class HandlerNotificationRequest(Base):
     __tablename__ = 'handler_notification_request'
+    __table_args__ = (
+        # Полоса первых попыток (см. worker.lanes) не сканирует повторы
+        Index('ix_handler_notification_request_first_attempt', 'next_attempt_at', postgresql_where=text('attempts = 0')),
+        # Для worker.notify_handlers.claim_batches: просмотр первых по времени и ранжирование уведомлений выбранных handler_url
+        Index('ix_handler_notification_request_batching', 'next_attempt_at', postgresql_where=text('batching IS true')),
+        Index('ix_handler_notification_request_batching_url', 'handler_url', 'next_attempt_at', postgresql_where=text('batching IS true')),
+    )
 
     id: Mapped[UUID] = mapped_column(primary_key=True)
     created_at: Mapped[datetime] = mapped_column(index=True)
-    processed_at: Mapped[datetime | None] = mapped_column(index=True, nullable=True)
+    processed_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    next_attempt_at: Mapped[datetime] = mapped_column(index=True)
+    attempts: Mapped[int] = mapped_column(server_default='0')
+    claimed_by: Mapped[str | None] = mapped_column(nullable=True)
+    lease_until: Mapped[datetime | None] = mapped_column(nullable=True)
+    lease_token: Mapped[UUID | None] = mapped_column(nullable=True)  # Своя у каждой аренды, см. worker.lease
     handler_url: Mapped[str] = mapped_column()
+    handler_host: Mapped[str] = mapped_column()  # Адресат (host:port) из handler_url
+    batching: Mapped[bool] = mapped_column(server_default='false')  # Отправляется в массиве вместе с другими
+    trace_id: Mapped[str | None] = mapped_column(nullable=True)  # См. tracing
     data: Mapped[dict[str, Any]] = mapped_column()
\ No newline at end of file
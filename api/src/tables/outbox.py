@@ -0,0 +1,18 @@
+from datetime import datetime
+from typing import Any
+from sqlalchemy import BigInteger
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+# Сообщения для kafka, записываемые в той же транзакции, что и изменение статуса
+class OutboxMessage(Base):
+    __tablename__ = 'outbox'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    created_at: Mapped[datetime] = mapped_column()
+    topic: Mapped[str] = mapped_column()
+    key: Mapped[str | None] = mapped_column(nullable=True)
+    value: Mapped[dict[str, Any]] = mapped_column()
+    trace_id: Mapped[str | None] = mapped_column(nullable=True)  # Заголовок X-Request-Id сообщения, см. tracing
@@ -1,7 +1,7 @@
 from uuid import UUID
 from datetime import datetime
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, text
 from typing import Any
 
 from .base import Base
@@ -10,10 +10,21 @@ from .payment import Payment
 
 class PaymentRequest(Base):
     __tablename__ = 'payment_request'
+    __table_args__ = (
+        # Полоса первых попыток (см. worker.lanes) не сканирует повторы
+        Index('ix_payment_request_first_attempt', 'next_attempt_at', postgresql_where=text('attempts = 0')),
+    )
 
     id: Mapped[UUID] = mapped_column(primary_key=True)
     created_at: Mapped[datetime] = mapped_column(index=True)
-    processed_at: Mapped[datetime | None] = mapped_column(index=True, nullable=True)
+    processed_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    next_attempt_at: Mapped[datetime] = mapped_column(index=True)
+    attempts: Mapped[int] = mapped_column(server_default='0')
+    claimed_by: Mapped[str | None] = mapped_column(nullable=True)
+    lease_until: Mapped[datetime | None] = mapped_column(nullable=True)
+    lease_token: Mapped[UUID | None] = mapped_column(nullable=True)  # Своя у каждой аренды, см. worker.lease
     payment_id: Mapped[UUID] = mapped_column(ForeignKey(Payment.id, ondelete='RESTRICT'), unique=True)
     handler_url: Mapped[str | None] = mapped_column(nullable=True)
+    handler_batching: Mapped[bool] = mapped_column(server_default='false')
+    trace_id: Mapped[str | None] = mapped_column(nullable=True)  # См. tracing
     extra_data: Mapped[dict[str, Any] | None] = mapped_column(nullable=True)
\ No newline at end of file
@@ -0,0 +1,230 @@
+import re
+import sys
+import time
+import json
+import queue
+import atexit
+import logging
+import secrets
+import threading
+from typing import Any, Iterator, Protocol, TextIO
+from dataclasses import dataclass, field, asdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from settings import settings
+
+
+# Трассировка платежа от запроса к API до уведомления обработчика.
+# trace_id - X-Request-Id от nginx (или новый, если его нет), он сохраняется в строках очередей
+# (payment_request, refund_request, handler_notification_request, outbox) и продолжается в воркере,
+# а в kafka и обработчики передается заголовком X-Request-Id.
+# Спаны отдаются экспортеру (settings.tracing_exporter, или свой - через tracing.exporter),
+# без экспортера сохраняется и передается только trace_id
+
+
+logger = logging.getLogger('tracing')
+
+REQUEST_ID_HEADER = 'X-Request-Id'
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    started_at: float  # Unix time
+    duration: float = field(default=0.0)
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = field(default=None)
+
+
+class Exporter(Protocol):
+    def export(self, span: Span): ...
+
+
+# Одна строка JSON на спан.
+# export вызывается в цикле событий (в том числе на каждый SQL-запрос), поэтому только кладет спан в очередь,
+# а сериализует и пишет пачками отдельный поток. Если поток не успевает, лишние спаны отбрасываются
+class StreamExporter:
+    def __init__(self, stream: TextIO, close_stream: bool, max_queue_size: int = 10000, max_batch_size: int = 500):
+        self._stream = stream
+        self._close_stream = close_stream
+        self._max_batch_size = max_batch_size
+        self._queue = queue.Queue[Span | None](max_queue_size)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._write, name='tracing-exporter', daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self._dropped += 1
+
+    # Дописывает спаны из очереди и закрывает файл
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._close_stream:
+            self._stream.close()
+
+    def _write(self):
+        closed = False
+        while not closed:
+            batch = [self._queue.get()]
+            while len(batch) < self._max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = list[str]()
+            for span in batch:
+                if span is None:
+                    closed = True
+                else:
+                    lines.append(json.dumps(asdict(span), ensure_ascii=False, default=str) + '\n')
+
+            try:
+                self._stream.writelines(lines)
+                self._stream.flush()
+            except (OSError, ValueError) as e:
+                logger.warning(f'couldn\'t write {len(lines)} span(s): {str(e)}')
+
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                logger.warning(f'dropped {dropped} span(s), exporter queue is full')
+
+
+exporter: Exporter | None = None
+
+
+# Можно вызывать повторно (каждый запуск приложения): прежний экспортер закрывается
+def configure():
+    global exporter
+    if isinstance(exporter, StreamExporter):
+        exporter.close()
+
+    match settings.tracing_exporter:
+        case 'stdout':
+            exporter = StreamExporter(sys.stdout, close_stream=False)
+        case 'file':
+            exporter = StreamExporter(open(settings.tracing_file_path, 'a', encoding='utf-8'), close_stream=True)
+        case 'none':
+            exporter = None
+
+
+@atexit.register
+def _close_exporter():
+    if isinstance(exporter, StreamExporter):
+        exporter.close()
+
+
+@dataclass(frozen=True)
+class _Context:
+    trace_id: str
+    span_id: str | None
+
+
+_current = ContextVar[_Context | None]('trace', default=None)
+
+_trace_id_pattern = re.compile(r'[0-9A-Za-z\-]{1,64}')
+
+
+def new_id() -> str:
+    return secrets.token_hex(16)
+
+
+def current_trace_id() -> str | None:
+    return context.trace_id if (context := _current.get()) is not None else None
+
+
+# Начинает трассу: запрос к API (trace_id из X-Request-Id) или задача воркера (trace_id из строки очереди)
+@contextmanager
+def trace(trace_id: str | None, name: str, **attributes: Any) -> Iterator[Span]:
+    if trace_id is None or not _trace_id_pattern.fullmatch(trace_id):
+        trace_id = new_id()
+
+    token = _current.set(_Context(trace_id=trace_id, span_id=None))
+    try:
+        with span(name, **attributes) as root:
+            assert root is not None
+            yield root
+    finally:
+        _current.reset(token)
+
+
+# Дочерний спан текущего. Вне трассы ничего не записывает
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+    if (context := _current.get()) is None:
+        yield None
+        return
+
+    current = Span(
+        trace_id=context.trace_id,
+        span_id=new_id()[:16],
+        parent_id=context.span_id,
+        name=name,
+        started_at=time.time(),
+        attributes=attributes
+    )
+    started = time.monotonic()
+    token = _current.set(_Context(trace_id=context.trace_id, span_id=current.span_id))
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        current.duration = time.monotonic() - started
+        if exporter is not None:
+            exporter.export(current)
+
+
+# Уже завершившийся дочерний спан текущего (started - time.monotonic() в начале), для событий SQLAlchemy
+def record(name: str, started: float, **attributes: Any):
+    if exporter is None or (context := _current.get()) is None:
+        return
+
+    duration = time.monotonic() - started
+    exporter.export(Span(
+        trace_id=context.trace_id,
+        span_id=new_id()[:16],
+        parent_id=context.span_id,
+        name=name,
+        started_at=time.time() - duration,
+        duration=duration,
+        attributes=attributes
+    ))
+
+
+# Общая операция для нескольких трасс (массив уведомлений, пачка сообщений kafka):
+# в каждую трассу записывается спан с одинаковой длительностью
+@contextmanager
+def shared(trace_ids: list[str | None], name: str, **attributes: Any) -> Iterator[None]:
+    started_at = time.time()
+    started = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if exporter is not None:
+            duration = time.monotonic() - started
+            for trace_id in dict.fromkeys(t for t in trace_ids if t is not None):
+                exporter.export(Span(
+                    trace_id=trace_id,
+                    span_id=new_id()[:16],
+                    parent_id=None,
+                    name=name,
+                    started_at=started_at,
+                    duration=duration,
+                    attributes=attributes,
+                    error=error
+                ))
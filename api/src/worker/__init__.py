@@ -2,33 +2,111 @@ import httpx
 import aiokafka
 import logging
 import anyio
+import orjson
+from enum import Enum
+from typing import Collection
+from contextlib import AsyncExitStack
 
+import tables
+import tracing
+import db.listener
 from .refund import refund_loop
 from .poll_payments import payments_polling_loop
 from .notify_handlers import handlers_notification_loop
-from settings import yookassa_settings, kafka_settings
+from .outbox import outbox_relay_loop
+from .wakeup import Wakeup
+from . import lease, metrics
+from settings import settings, yookassa_settings, kafka_settings, ConcurrencyPolicy
 
 
 logger = logging.getLogger('bill-worker')
 
 
-async def run():
-    yookassa_client = yookassa_client=httpx.AsyncClient(
-        base_url=yookassa_settings.base_url,
-        auth=httpx.BasicAuth(yookassa_settings.shop_id, yookassa_settings.secret_key),
-        timeout=yookassa_settings.connection_timeout_sec
-    )
-    handler_client = httpx.AsyncClient()
+# Циклы воркера можно запускать в отдельных процессах (подах), например `python -m worker payments`,
+# чтобы масштабировать их независимо. Каждая роль создает только нужные ей клиенты
+class Role(str, Enum):
+    payments = 'payments'
+    refunds = 'refunds'
+    notifications = 'notifications'
+    outbox = 'outbox'
 
-    kafka_producer = aiokafka.AIOKafkaProducer(bootstrap_servers=kafka_settings.bootstrap_servers)
-    await kafka_producer.start()
 
-    try:
+async def run(
+    roles: Collection[Role] = tuple(Role),
+    partition: lease.Partition = lease.Partition(index=0, count=1),
+    concurrency: int | None = None  # Верхняя граница *_concurrency из настроек, для всех ролей
+):
+    lease.partition = partition
+    tracing.configure()
+
+    if settings.worker_metrics_port is not None:
+        metrics.serve(settings.worker_metrics_port + partition.index)
+
+    def policy(configured: ConcurrencyPolicy) -> ConcurrencyPolicy:
+        return configured if concurrency is None else configured.capped(concurrency)
+
+    async with AsyncExitStack() as stack:
+        if Role.payments in roles or Role.refunds in roles:
+            yookassa_client = await stack.enter_async_context(httpx.AsyncClient(
+                base_url=yookassa_settings.base_url,
+                auth=httpx.BasicAuth(yookassa_settings.shop_id, yookassa_settings.secret_key),
+                timeout=yookassa_settings.connection_timeout_sec,
+                event_hooks=metrics.event_hooks('yookassa')
+            ))
+
+        if Role.outbox in roles:
+            kafka_producer = aiokafka.AIOKafkaProducer(
+                bootstrap_servers=kafka_settings.bootstrap_servers,
+                compression_type=kafka_settings.compression_type,
+                linger_ms=kafka_settings.linger_ms,
+                max_batch_size=kafka_settings.max_batch_size,
+                max_request_size=kafka_settings.max_request_size,
+                acks=kafka_settings.acks,
+                request_timeout_ms=kafka_settings.request_timeout_ms,
+                value_serializer=orjson.dumps
+            )
+            await kafka_producer.start()
+            stack.push_async_callback(kafka_producer.stop)
+
+        # Канал LISTEN/NOTIFY очереди - имя ее таблицы
+        queues: dict[Role, metrics.Queue] = {
+            Role.refunds: tables.RefundRequest,
+            Role.payments: tables.PaymentRequest,
+            Role.notifications: tables.HandlerNotificationRequest,
+            Role.outbox: tables.OutboxMessage
+        }
+        wakeups = {role: Wakeup() for role in roles}
+
+        listener = db.listener.Listener([queues[role].__tablename__ for role in roles])
+        for role in roles:
+            listener.subscribe(queues[role].__tablename__, wakeups[role].set)
+
         async with anyio.create_task_group() as tg:
-            tg.start_soon(refund_loop, yookassa_client, kafka_producer)
-            tg.start_soon(payments_polling_loop, yookassa_client, kafka_producer)
-            tg.start_soon(handlers_notification_loop, handler_client)
+            tg.start_soon(listener.run)
+            tg.start_soon(metrics.sample_queues_loop, [queues[role] for role in roles])
+
+            if Role.refunds in roles:
+                tg.start_soon(
+                    refund_loop,
+                    yookassa_client,
+                    wakeups[Role.refunds],
+                    policy(settings.refund_loop_concurrency)
+                )
+            if Role.payments in roles:
+                tg.start_soon(
+                    payments_polling_loop,
+                    yookassa_client,
+                    wakeups[Role.payments],
+                    policy(settings.payments_polling_loop_concurrency)
+                )
+            if Role.notifications in roles:
+                tg.start_soon(
+                    handlers_notification_loop,
+                    wakeups[Role.notifications],
+                    policy(settings.handlers_notification_loop_concurrency)
+                )
+            if Role.outbox in roles:
+                tg.start_soon(outbox_relay_loop, kafka_producer, wakeups[Role.outbox])
 
-            logger.info('worker is started')
-    finally:
-        await kafka_producer.stop()
\ No newline at end of file
+            role_names = ', '.join(role.value for role in roles)
+            logger.info(f'worker is started: {role_names} (partition {partition.index + 1}/{partition.count})')
@@ -1,14 +1,22 @@
-import logging
-import asyncio
-from . import run
+import typer
+
+from . import Role
+from .lease import Partition
+from .supervisor import run_process, supervise
+
+
+def main(
+    roles: list[Role] | None = typer.Argument(default=None, help='Запускаемые циклы, по умолчанию - все'),
+    concurrency: int | None = typer.Option(default=None, min=1, help='Максимальная конкурентность циклов, вместо max из *_CONCURRENCY в настройках'),
+    processes: int = typer.Option(default=1, min=1, help='Число процессов воркера, каждый со своим разделом очередей')
+):
+    roles = list(dict.fromkeys(roles or Role))
+
+    if processes == 1:
+        run_process(roles, Partition(index=0, count=1), concurrency)
+    else:
+        supervise(processes, roles, concurrency)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s %(levelname)s: %(message)s'
-    )
-    import httpx  # noqa
-    logging.getLogger('httpx').setLevel(logging.WARNING)
-
-    asyncio.run(run())
\ No newline at end of file
+    typer.run(main)
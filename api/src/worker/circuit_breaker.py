@@ -0,0 +1,70 @@
+import time
+from typing import Literal
+from dataclasses import dataclass, field
+
+from settings import settings
+
+
+# Автомат на каждый handler_url:
+# closed    - уведомления доставляются как обычно, считаем подряд идущие ошибки
+# open      - после handler_breaker_failure_threshold ошибок подряд строки обработчика не забираются из очереди
+# half_open - через handler_breaker_open_duration пробуем доставить одно уведомление:
+#             успех закрывает автомат, ошибка снова открывает
+# Ошибки отправок, начатых до открытия, в состоянии open не учитываются - иначе они откладывали бы пробу
+
+
+State = Literal['closed', 'open', 'half_open']
+
+
+@dataclass
+class CircuitBreaker:
+    state: State = field(default='closed')
+    failures: int = field(default=0)
+    opened_at: float = field(default=0.0)
+    probing: bool = field(default=False)
+
+    def record(self, success: bool):
+        if success:
+            self.state = 'closed'
+            self.failures = 0
+        elif self.state == 'open':
+            return
+        else:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= settings.handler_breaker_failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+        self.probing = False
+
+    def refresh(self):
+        if self.state == 'open' and time.monotonic() - self.opened_at >= settings.handler_breaker_open_duration:
+            self.state = 'half_open'
+
+
+class CircuitBreakers:
+    def __init__(self):
+        self._breakers = dict[str, CircuitBreaker]()
+
+    def record(self, handler_url: str, success: bool):
+        if success and handler_url not in self._breakers:
+            return
+        self._breakers.setdefault(handler_url, CircuitBreaker()).record(success)
+
+    # Обработчики, строки которых не забираются обычным образом
+    def not_closed(self) -> list[str]:
+        for breaker in self._breakers.values():
+            breaker.refresh()
+        return [url for url, breaker in self._breakers.items() if breaker.state != 'closed']
+
+    # Обработчики, для которых пора сделать пробную доставку. Помечаются как проверяемые
+    def take_probes(self) -> list[str]:
+        urls = list[str]()
+        for url, breaker in self._breakers.items():
+            breaker.refresh()
+            if breaker.state == 'half_open' and not breaker.probing:
+                breaker.probing = True
+                urls.append(url)
+        return urls
+
+    def cancel_probe(self, handler_url: str):
+        self._breakers[handler_url].probing = False
@@ -0,0 +1,53 @@
+from typing import Literal
+from sqlalchemy import ColumnElement, SQLColumnExpression, literal
+
+from settings import settings
+
+
+# Полосы очереди по числу попыток: первая попытка, ранние повторы (до worker_early_retry_attempts) и долгие повторы.
+# Аренда распределяется между полосами по весам (smooth weighted round robin, как в nginx),
+# а пустая полоса отдает свою долю остальным. Поэтому новые запросы не ждут за тысячами повторов
+
+
+Lane = Literal['first', 'early', 'long_tail']
+
+LANES: tuple[Lane, ...] = ('first', 'early', 'long_tail')
+
+
+def lane_of(attempts: SQLColumnExpression[int], lane: Lane) -> ColumnElement[bool]:
+    match lane:
+        case 'first':
+            # Значение подставляется в текст запроса, чтобы подготовленный запрос подходил под частичный индекс
+            return attempts == literal(0, literal_execute=True)
+        case 'early':
+            return attempts.between(1, settings.worker_early_retry_attempts)
+        case 'long_tail':
+            return attempts > settings.worker_early_retry_attempts
+
+
+class LaneScheduler:
+    def __init__(self):
+        self._weights: dict[Lane, int] = {
+            'first': settings.worker_first_attempt_lane_weight,
+            'early': settings.worker_early_retry_lane_weight,
+            'long_tail': settings.worker_long_tail_lane_weight
+        }
+        self._current: dict[Lane, int] = {lane: 0 for lane in LANES}
+
+    def next(self) -> Lane:
+        for lane, weight in self._weights.items():
+            self._current[lane] += weight
+
+        lane = max(LANES, key=lambda lane: self._current[lane])
+        self._current[lane] -= sum(self._weights.values())
+        return lane
+
+
+# По планировщику на очередь (таблицу)
+schedulers = dict[str, LaneScheduler]()
+
+
+def next_lane(queue: str) -> Lane:
+    if (scheduler := schedulers.get(queue)) is None:
+        scheduler = schedulers[queue] = LaneScheduler()
+    return scheduler.next()
@@ -0,0 +1,249 @@
+import os
+import socket
+from typing import Any, Awaitable, Callable, TypeVar
+from uuid import UUID, uuid4
+from datetime import datetime, timedelta
+from dataclasses import dataclass
+from sqlalchemy import ColumnElement, Row, Select, String, Table, select, update, delete, bindparam, or_, and_, func, cast, true, tuple_
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import tables
+import db.postgres
+from settings import settings, BackoffPolicy
+from .lanes import Lane, LANES, lane_of, next_lane
+from . import metrics
+
+
+# Строки очередей не блокируются на время обработки.
+# Воркер "арендует" строки короткой транзакцией (claimed_by/lease_until), делает внешние запросы
+# без открытого соединения, и завершает обработку второй короткой транзакцией.
+# При аренде next_attempt_at сдвигается на конец аренды: если воркер упал, строка снова станет доступной.
+# Каждая аренда получает свой lease_token, и завершить или вернуть строку можно только с ним: задача, аренда
+# которой истекла, не затрет результат следующей аренды, даже если строку забрал тот же процесс
+
+
+RequestTable = TypeVar(
+    'RequestTable',
+    tables.PaymentRequest,
+    tables.RefundRequest,
+    tables.HandlerNotificationRequest
+)
+Claimed = TypeVar('Claimed')
+
+
+worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}'
+
+
+# Раздел очередей, который обрабатывает процесс (python -m worker --processes N).
+# Процессы забирают только строки своего раздела и не конкурируют за одни и те же строки.
+# Если в своем разделе пусто, процесс забирает строки других разделов, ожидающие дольше worker_steal_delay
+# (владелец раздела упал и перезапускается, или не успевает)
+@dataclass(frozen=True)
+class Partition:
+    index: int
+    count: int
+
+
+partition = Partition(index=0, count=1)
+
+
+def in_partition(table: type[RequestTable]) -> ColumnElement[bool]:
+    if partition.count == 1:
+        return true()
+
+    # Уведомления делятся по адресатам, чтобы лимиты и circuit breaker адресата были в одном процессе
+    key = table.handler_host if issubclass(table, tables.HandlerNotificationRequest) else cast(table.id, String)
+    return func.hashtext(key).op('&')(0x7fffffff) % partition.count == partition.index
+
+
+def overdue(table: type[RequestTable]) -> ColumnElement[bool]:
+    return table.next_attempt_at <= datetime.now() - timedelta(seconds=settings.worker_steal_delay)
+
+
+# claim получает условие: строки полосы lane своего раздела (см. worker.lanes), если там пусто - любые строки
+# своего раздела, и если пусто и там - просроченные строки любого раздела
+async def claim_partitioned(
+    table: type[RequestTable],
+    claim: Callable[[ColumnElement[bool]], Awaitable[list[Claimed]]],
+    lane: Lane | None = None
+) -> list[Claimed]:
+    if lane is not None and (claimed := await claim(and_(in_partition(table), lane_of(table.attempts, lane)))):
+        return claimed
+
+    claimed = await claim(in_partition(table))
+    if not claimed and partition.count > 1:
+        claimed = await claim(overdue(table))
+    return claimed
+
+
+# Строит по арендованным строкам (алиас таблицы над CTE с UPDATE ... RETURNING) запрос,
+# загружающий вместе с ними связанные строки. Так аренда и загрузка - один запрос
+Load = Callable[[type[RequestTable]], Select[Any]]
+
+
+# По умолчанию забираются только строки, время попытки которых подошло.
+# С only_due=False - любые свободные строки, подходящие под условия where
+async def claim(
+    table: type[RequestTable],
+    limit: int,
+    *where: ColumnElement[bool],
+    only_due: bool = True
+) -> list[RequestTable]:
+    return await claim_partitioned(table, lambda partitioned: claim_selected(
+        table,
+        due(table, limit, *where, partitioned, only_due=only_due)
+    ), next_lane(table.__tablename__) if only_due else None)
+
+
+async def claim_loading(
+    table: type[RequestTable],
+    load: Load[RequestTable],
+    limit: int,
+    *where: ColumnElement[bool],
+    only_due: bool = True
+) -> list[Row[Any]]:
+    return await claim_partitioned(table, lambda partitioned: claim_selected_loading(
+        table,
+        load,
+        due(table, limit, *where, partitioned, only_due=only_due)
+    ), next_lane(table.__tablename__) if only_due else None)
+
+
+def due(
+    table: type[RequestTable],
+    limit: int,
+    *where: ColumnElement[bool],
+    only_due: bool
+) -> Select[tuple[UUID]]:
+    now = datetime.now()
+
+    # Простой range scan по индексу next_attempt_at
+    return (
+        select(table.id)
+        .where(table.next_attempt_at <= now if only_due else or_(
+            table.claimed_by.is_(None),
+            table.lease_until < now
+        ))
+        .where(*where)
+        .order_by(table.next_attempt_at.asc())
+        .with_for_update(skip_locked=True)
+        .limit(limit)
+    )
+
+
+# Арендует строки, выбранные запросом claimable (id строк, с FOR UPDATE SKIP LOCKED)
+async def claim_selected(
+    table: type[RequestTable],
+    claimable: Select[tuple[UUID]]
+) -> list[RequestTable]:
+    return [row[0] for row in await claim_selected_loading(table, select, claimable)]
+
+
+async def claim_selected_loading(
+    table: type[RequestTable],
+    load: Load[RequestTable],
+    claimable: Select[tuple[UUID]]
+) -> list[Row[Any]]:
+    lease_until = datetime.now() + timedelta(seconds=settings.worker_lease_duration)
+
+    claimed = aliased(table, (
+        update(table)
+        .where(table.id.in_(claimable.scalar_subquery()))
+        .values({
+            table.claimed_by: worker_id,
+            table.lease_until: lease_until,
+            table.lease_token: uuid4(),
+            table.next_attempt_at: lease_until,
+            table.attempts: table.attempts + 1
+        })
+        .returning(table)
+        .cte('claimed')
+    ))
+
+    with metrics.claim_duration.labels(table.__tablename__).time():
+        async with db.postgres.session_maker(expire_on_commit=False) as session, session.begin():
+            return list(await session.execute(load(claimed)))
+
+
+# Число строк своего раздела по полосам, время попытки которых подошло (всего не больше limit)
+async def depth(table: type[RequestTable], limit: int, *where: ColumnElement[bool]) -> dict[Lane, int]:
+    pending = (
+        select(table.attempts)
+        .where(table.next_attempt_at <= datetime.now(), in_partition(table), *where)
+        .limit(limit)
+        .subquery()
+    )
+
+    async with db.postgres.session_maker() as session:
+        counts = (await session.execute(select(*(
+            func.count().filter(lane_of(pending.c.attempts, lane))
+            for lane in LANES
+        )))).one()
+
+    return dict(zip(LANES, counts))
+
+
+# Удаляет обработанные строки, если их аренда все еще та же. Возвращает id удаленных строк
+async def complete(
+    session: AsyncSession,
+    table: type[RequestTable],
+    requests: list[RequestTable]
+) -> set[UUID]:
+    if not requests:
+        return set()
+
+    return set(await session.scalars(
+        delete(table)
+        .where(tuple_(table.id, table.lease_token).in_([(request.id, request.lease_token) for request in requests]))
+        .returning(table.id)
+    ))
+
+
+# Возвращает строки в очередь, следующая попытка - с задержкой по политике повторов
+async def release(
+    session: AsyncSession,
+    table: type[RequestTable],
+    requests: list[RequestTable],
+    backoff: BackoffPolicy
+):
+    now = datetime.now()
+    await release_at(session, table, [
+        (request, now + timedelta(seconds=backoff.delay(request.attempts)))
+        for request in requests
+    ])
+
+
+# Возвращает строки в очередь, каждую - со своим временем следующей попытки
+async def release_at(
+    session: AsyncSession,
+    table: type[RequestTable],
+    requests: list[tuple[RequestTable, datetime]]
+):
+    if not requests:
+        return
+
+    now = datetime.now()
+    mapped_table = table.__table__
+    assert isinstance(mapped_table, Table)
+    columns = mapped_table.c
+
+    await session.execute(
+        update(mapped_table)
+        .where(columns.id == bindparam('_id'), columns.lease_token == bindparam('_lease_token'))
+        .values({
+            columns.processed_at: now,
+            columns.next_attempt_at: bindparam('_next_attempt_at'),
+            columns.claimed_by: None,
+            columns.lease_until: None,
+            columns.lease_token: None
+        }),
+        [
+            {
+                '_id': request.id,
+                '_lease_token': request.lease_token,
+                '_next_attempt_at': next_attempt_at
+            }
+            for request, next_attempt_at in requests
+        ]
+    )
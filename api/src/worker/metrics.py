@@ -0,0 +1,101 @@
+import time
+import asyncio
+import logging
+import httpx
+import prometheus_client
+from typing import Any
+from datetime import datetime
+from sqlalchemy import select, func
+
+import tables
+import db.postgres
+from settings import settings
+
+
+logger = logging.getLogger('bill-worker-metrics')
+
+
+# Метрики воркера отдаются по HTTP (settings.worker_metrics_port, у процесса с разделом i - порт + i).
+# Длина очередей считается пулами (WorkerPool) раз в worker_concurrency_adjust_interval,
+# возраст самых старых строк - раз в worker_metrics_sample_interval, а не на каждый запрос метрик
+
+
+claim_duration = prometheus_client.Histogram(
+    'bill_worker_claim_duration_seconds', 'Аренда строк очереди (вместе с загрузкой связанных строк)',
+    ['queue'], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+job_duration = prometheus_client.Histogram(
+    'bill_worker_job_duration_seconds', 'Обработка арендованных строк',
+    ['loop'], buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+requests_processed = prometheus_client.Counter(
+    'bill_worker_requests', 'Обработанные строки очередей по результату: done, retry (еще не готово), error',
+    ['loop', 'outcome']
+)
+downstream_duration = prometheus_client.Histogram(
+    'bill_worker_downstream_duration_seconds', 'Запросы к внешним сервисам: yookassa, handler, kafka (пачка сообщений)',
+    ['target'], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+concurrency = prometheus_client.Gauge('bill_worker_concurrency', 'Текущая конкурентность цикла', ['loop'])
+busy = prometheus_client.Gauge('bill_worker_busy', 'Обработчики цикла, занятые задачей', ['loop'])
+queue_depth = prometheus_client.Gauge(
+    'bill_worker_queue_depth', 'Строки своего раздела, время попытки которых подошло (с ограничением сверху)',
+    ['queue', 'lane']
+)
+queue_oldest_age = prometheus_client.Gauge(
+    'bill_worker_queue_oldest_age_seconds', 'Возраст самой старой строки очереди', ['queue']
+)
+
+
+_server_started = False
+
+
+def serve(port: int):
+    global _server_started
+    if _server_started:
+        return
+
+    prometheus_client.start_http_server(port)
+    _server_started = True
+    logger.info(f'serving metrics on port {port}')
+
+
+# Для httpx.AsyncClient(event_hooks=...): длительность запроса до получения заголовков ответа
+def event_hooks(target: str) -> dict[str, list[Any]]:
+    async def on_request(request: httpx.Request):
+        request.extensions['started'] = time.monotonic()
+
+    async def on_response(response: httpx.Response):
+        if (started := response.request.extensions.get('started')) is not None:
+            downstream_duration.labels(target).observe(time.monotonic() - started)
+
+    return {'request': [on_request], 'response': [on_response]}
+
+
+Queue = type[tables.PaymentRequest | tables.RefundRequest | tables.HandlerNotificationRequest | tables.OutboxMessage]
+
+
+async def sample_queues_loop(queues: list[Queue]):
+    while True:
+        now = datetime.now()
+
+        # Ошибка сбора метрик не должна останавливать воркер: остаются прошлые значения
+        try:
+            async with db.postgres.session_maker() as session:
+                for table in queues:
+                    if table is tables.OutboxMessage:
+                        # id outbox растет вместе с created_at
+                        oldest = await session.scalar(
+                            select(tables.OutboxMessage.created_at)
+                            .order_by(tables.OutboxMessage.id.asc())
+                            .limit(1)
+                        )
+                    else:
+                        # По индексу created_at
+                        oldest = await session.scalar(select(func.min(table.created_at)))
+
+                    queue_oldest_age.labels(table.__tablename__).set((now - oldest).total_seconds() if oldest else 0.0)
+        except Exception:
+            logger.exception('failed to sample queues')
+
+        await asyncio.sleep(settings.worker_metrics_sample_interval)
@@ -1,76 +1,456 @@
-import asyncio
 import httpx
 import logging
 import anyio
+import importlib.util
+from uuid import UUID
 from datetime import datetime, timedelta
-from sqlalchemy import select, update, nulls_last, or_
+from collections import defaultdict
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+from sqlalchemy import ColumnElement, select, insert, delete, func, literal, case, or_
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import tables
+import tracing
 import db.postgres
-from settings import settings
+from settings import settings, ConcurrencyPolicy
+from . import lease
+from .pool import WorkerPool, JobResult
+from . import metrics
+from .lanes import next_lane
+from .wakeup import Wakeup
+from .circuit_breaker import CircuitBreakers
 
 
 logger = logging.getLogger('bill-worker-handlers-notification-loop')
 
 
-async def handlers_notification_loop(handler_client: httpx.AsyncClient):
-    limiter = anyio.CapacityLimiter(settings.handlers_notification_loop_concurrency)
+# Обработчики разных сервисов изолированы друг от друга (bulkhead):
+# у каждого адресата (host:port) свой пул соединений и свой лимит одновременных запросов,
+# а адресаты, у которых лимит исчерпан, не забираются из очереди.
+# Уведомления адресатов отправляются фоновыми задачами, задача пула освобождается сразу после аренды.
+# Поэтому медленный обработчик не занимает слоты остальных
 
-    async def try_notify_some_handler():
-        async with limiter:
-            async with db.postgres.session_maker() as session:
-                request = await session.scalar(
-                    select(tables.HandlerNotificationRequest)
-                    .where(or_(
-                        tables.HandlerNotificationRequest.processed_at.is_(None),
-                        tables.HandlerNotificationRequest.processed_at < (datetime.now() - timedelta(seconds=settings.handlers_notification_loop_sleep_duration))
-                    ))
-                    .order_by(nulls_last(tables.HandlerNotificationRequest.processed_at.asc()))
-                    .with_for_update(skip_locked=True)
-                    .limit(1)
-                )
 
-                if request:
-                    if await notify_handler(request, handler_client):
-                        await session.delete(request)
-                    else:
-                        await session.execute(
-                            update(tables.HandlerNotificationRequest.processed_at)
-                            .where(tables.HandlerNotificationRequest.id == request.id)
-                            .values({tables.HandlerNotificationRequest.processed_at: datetime.now()})
-                        )
+def destination_of(handler_url: str) -> str:
+    return urlsplit(handler_url).netloc
 
-                    await session.commit()
-                    return
 
-            await asyncio.sleep(settings.handlers_notification_loop_sleep_duration)
+# Уведомление с batching ждет handler_batch_window, чтобы собрать массив с последующими
+def first_attempt_at(batching: bool, now: datetime) -> datetime:
+    return now + timedelta(seconds=settings.handler_batch_window) if batching else now
 
 
-    async with anyio.create_task_group() as tg:
-        while True:
-            async with limiter:
-                tg.start_soon(try_notify_some_handler)
-            await asyncio.sleep(0)
+@dataclass
+class Destination:
+    host: str
+    client: httpx.AsyncClient
+    limiter: anyio.CapacityLimiter
+    claimed: int = field(default=0)  # Отправки в процессе
 
+    @property
+    def available(self) -> int:
+        return max(settings.handler_destination_concurrency - self.claimed, 0)
 
+
+class Destinations:
+    def __init__(self):
+        self._destinations = dict[str, Destination]()
+
+    def get(self, host: str) -> Destination:
+        if (destination := self._destinations.get(host)) is None:
+            # HTTP/2 согласуется через ALPN, поэтому используется только там, где обработчик его поддерживает
+            http2 = settings.handler_http2 and importlib.util.find_spec('h2') is not None
+
+            destination = self._destinations[host] = Destination(
+                host=host,
+                client=httpx.AsyncClient(
+                    http2=http2,
+                    event_hooks=metrics.event_hooks('handler'),
+                    timeout=settings.handler_notification_timeout,
+                    limits=httpx.Limits(
+                        max_connections=settings.handler_destination_concurrency,
+                        max_keepalive_connections=settings.handler_destination_concurrency,
+                        keepalive_expiry=settings.handler_destination_keepalive_expiry
+                    )
+                ),
+                limiter=anyio.CapacityLimiter(settings.handler_destination_concurrency)
+            )
+
+        return destination
+
+    def saturated(self) -> list[str]:
+        return [host for host, destination in self._destinations.items() if not destination.available]
+
+    # Сколько еще строк можно забрать для адресатов, у которых уже есть отправки в процессе
+    def busy(self) -> dict[str, int]:
+        return {
+            host: destination.available
+            for host, destination in self._destinations.items()
+            if destination.claimed and destination.available
+        }
+
+    def in_flight(self) -> int:
+        return sum(destination.claimed for destination in self._destinations.values())
+
+    async def aclose(self):
+        for destination in self._destinations.values():
+            await destination.client.aclose()
+
+
+async def handlers_notification_loop(wakeup: Wakeup, concurrency: ConcurrencyPolicy):
+    table = tables.HandlerNotificationRequest
+    batch_size = settings.handlers_notification_loop_batch_size
+    destinations = Destinations()
+    breakers = CircuitBreakers()
+
+    try:
+        async with anyio.create_task_group() as deliveries:
+            async def deliver(destination: Destination, host_deliveries: list[Delivery]):
+                failed = await notify_destination(destination, breakers, host_deliveries)
+                pool.report(JobResult(claimed=sum(len(delivery) for delivery in host_deliveries), failed=failed))
+
+            async def try_notify_some_handlers() -> JobResult:
+                # Общий предел отправок в процессе, как если бы каждая задача пула ждала свои отправки
+                if destinations.in_flight() >= concurrency.max * batch_size:
+                    return JobResult(claimed=0)
+
+                requests = await lease.claim_partitioned(table, lambda partitioned: claim_requests(
+                    destinations.saturated(), destinations.busy(), breakers.not_closed(), partitioned
+                ), next_lane(table.__tablename__))
+                # Массивы собираются по handler_url из всех полос
+                requests += await lease.claim_partitioned(table, lambda partitioned: claim_batches(
+                    destinations.saturated(), breakers.not_closed(), partitioned
+                ))
+                requests += await claim_probes(breakers)
+
+                if not requests:
+                    return JobResult(claimed=0)
+
+                for host, host_deliveries in deliveries_by_host(requests).items():
+                    destination = destinations.get(host)
+                    # Сразу, а не в фоновой задаче: следующая аренда должна видеть занятость адресата
+                    destination.claimed += len(host_deliveries)
+                    deliveries.start_soon(deliver, destination, host_deliveries)
+
+                return JobResult(claimed=len(requests), dispatched=True)
+
+            pool = WorkerPool(
+                name='notifications',
+                queue=table.__tablename__,
+                policy=concurrency,
+                job=try_notify_some_handlers,
+                # Уведомления обработчиков с открытым circuit breaker не ускорит рост конкурентности
+                depth=lambda: lease.depth(
+                    table,
+                    concurrency.max * batch_size * 2,
+                    table.handler_url.not_in(breakers.not_closed())
+                ),
+                job_size=batch_size,
+                wakeup=wakeup,
+                sleep_duration=settings.handlers_notification_loop_sleep_duration
+            )
+
+            await pool.run()
+    finally:
+        await destinations.aclose()
+
+
+# Сколько подошедших строк (во столько раз больше пачки) просматривается в claim_requests и claim_batches:
+# ранжируются не все подошедшие строки, а только первые по индексу next_attempt_at
+CLAIM_REQUESTS_SCAN_FACTOR = 4
+
+
+# Не больше свободных слотов адресата (handler_destination_concurrency без отправок в процессе, см. Destinations.busy)
+# строк на адресата, по очереди (round-robin) между адресатами
+async def claim_requests(
+    excluded_hosts: list[str],
+    busy: dict[str, int],
+    excluded_urls: list[str],
+    partitioned: ColumnElement[bool]
+) -> list[tables.HandlerNotificationRequest]:
+    table = tables.HandlerNotificationRequest
+    batch_size = settings.handlers_notification_loop_batch_size
+    now = datetime.now()
+    where = (
+        table.next_attempt_at <= now,
+        table.batching.is_(False),
+        table.handler_host.not_in(excluded_hosts),
+        table.handler_url.not_in(excluded_urls),
+        partitioned
+    )
+
+    due = (
+        select(table.id, table.handler_host, table.next_attempt_at)
+        .where(*where)
+        .order_by(table.next_attempt_at)
+        .limit(batch_size * CLAIM_REQUESTS_SCAN_FACTOR)
+        .subquery()
+    )
+    ranked = (
+        select(
+            due.c.id,
+            func.row_number().over(partition_by=due.c.handler_host, order_by=due.c.next_attempt_at).label('rank'),
+            (
+                case(busy, value=due.c.handler_host, else_=settings.handler_destination_concurrency)
+                if busy else
+                literal(settings.handler_destination_concurrency)
+            ).label('available')
+        )
+        .subquery()
+    )
+
+    return await lease.claim_selected(table, (
+        select(table.id)
+        .join(ranked, ranked.c.id == table.id)
+        # Условия повторяются для самой таблицы, чтобы перепроверяться после ожидания блокировки
+        .where(*where)
+        .where(ranked.c.rank <= ranked.c.available)
+        .order_by(ranked.c.rank, table.next_attempt_at)
+        .with_for_update(of=table, skip_locked=True)
+        .limit(batch_size)
+    ))
+
+
+# Массивы уведомлений для обработчиков с batching.
+# handler_url забирается, когда у первого уведомления истекло окно, или накопилось handler_batch_max_size уведомлений.
+# Вместе с ним забираются все свободные уведомления этого handler_url, попадающие в окно,
+# но не те, что ждут повтора после ошибки дольше окна.
+# handler_url выбираются по первым по времени уведомлениям (как в claim_requests), ранжируются только их уведомления
+async def claim_batches(
+    excluded_hosts: list[str],
+    excluded_urls: list[str],
+    partitioned: ColumnElement[bool]
+) -> list[tables.HandlerNotificationRequest]:
+    table = tables.HandlerNotificationRequest
+    now = datetime.now()
+    where = (
+        table.batching.is_(True),
+        table.next_attempt_at <= now + timedelta(seconds=settings.handler_batch_window),
+        or_(table.claimed_by.is_(None), table.lease_until < now),
+        table.handler_host.not_in(excluded_hosts),
+        table.handler_url.not_in(excluded_urls),
+        partitioned
+    )
+
+    due = (
+        select(table.handler_url, table.next_attempt_at)
+        .where(*where)
+        .order_by(table.next_attempt_at)
+        .limit(settings.handler_batch_max_size * CLAIM_REQUESTS_SCAN_FACTOR)
+        .subquery()
+    )
+    candidates = (
+        select(due.c.handler_url, func.min(due.c.next_attempt_at).label('first_attempt_at'))
+        .group_by(due.c.handler_url)
+        .having(or_(
+            func.min(due.c.next_attempt_at) <= now,
+            func.count() >= settings.handler_batch_max_size
+        ))
+        .subquery()
+    )
+    ranked = (
+        select(
+            table.id,
+            func.row_number().over(partition_by=table.handler_url, order_by=table.next_attempt_at).label('rank'),
+            candidates.c.first_attempt_at
+        )
+        .join(candidates, candidates.c.handler_url == table.handler_url)
+        .where(*where)
+        .subquery()
+    )
+
+    return await lease.claim_selected(table, (
+        select(table.id)
+        .join(ranked, ranked.c.id == table.id)
+        .where(*where)
+        .where(ranked.c.rank <= settings.handler_batch_max_size)
+        .order_by(ranked.c.first_attempt_at, table.handler_url, ranked.c.rank)
+        .with_for_update(of=table, skip_locked=True)
+        .limit(settings.handler_batch_max_size)
+    ))
+
+
+# По одному уведомлению для обработчиков в состоянии half_open.
+# Не через lease.claim: пробы не должны сдвигать очередь полос (см. worker.lanes)
+async def claim_probes(breakers: CircuitBreakers) -> list[tables.HandlerNotificationRequest]:
+    table = tables.HandlerNotificationRequest
+    requests = list[tables.HandlerNotificationRequest]()
+
+    for handler_url in breakers.take_probes():
+        probe = await lease.claim_partitioned(table, lambda partitioned: lease.claim_selected(
+            table,
+            lease.due(table, 1, table.handler_url == handler_url, partitioned, only_due=True)
+        ))
+        if not probe:
+            breakers.cancel_probe(handler_url)
+        requests += probe
+
+    return requests
+
+
+# Одна отправка - одно уведомление, или массив уведомлений (batching) для одного handler_url
+Delivery = list[tables.HandlerNotificationRequest]
+
+
+def deliveries_by_host(requests: list[tables.HandlerNotificationRequest]) -> dict[str, list[Delivery]]:
+    by_host = defaultdict[str, list[Delivery]](list)
+    batches = defaultdict[str, Delivery](list)
+    for request in requests:
+        if request.batching:
+            batches[request.handler_url].append(request)
+        else:
+            by_host[request.handler_host].append([request])
+    for batch in batches.values():
+        by_host[batch[0].handler_host].append(batch)
+    return by_host
+
+
+# Отправляет уведомления адресата и сохраняет результаты. destination.claimed увеличивает вызывающий
+async def notify_destination(
+    destination: Destination,
+    breakers: CircuitBreakers,
+    deliveries: list[Delivery]
+) -> int:
+    requests = [request for delivery in deliveries for request in delivery]
+
+    try:
+        errors = dict[UUID, str | None]()
+
+        async def notify(delivery: list[tables.HandlerNotificationRequest]):
+            async with destination.limiter:
+                with tracing.shared(
+                    [r.trace_id for r in delivery], 'handler',
+                    handler_url=delivery[0].handler_url, notifications=len(delivery)
+                ):
+                    error = await notify_handler(delivery, destination.client)
+            for request in delivery:
+                errors[request.id] = error
+            breakers.record(delivery[0].handler_url, error is None)
+
+        async with anyio.create_task_group() as tg:
+            for delivery in deliveries:
+                tg.start_soon(notify, delivery)
+
+        failed = [r for r in requests if errors[r.id] is not None]
+        expired_before = datetime.now() - timedelta(seconds=settings.handler_notification_max_age)
+        exhausted = [
+            r for r in failed
+            if r.attempts >= settings.handler_notification_max_attempts or r.created_at < expired_before
+        ]
+
+        async with db.postgres.session_maker() as session, session.begin():
+            await lease.complete(
+                session,
+                tables.HandlerNotificationRequest,
+                [r for r in requests if errors[r.id] is None]
+            )
+            await lease.release(
+                session,
+                tables.HandlerNotificationRequest,
+                [r for r in failed if r not in exhausted],
+                settings.handlers_notification_loop_backoff
+            )
+            await move_to_dead_letters(session, exhausted, errors)
+    finally:
+        destination.claimed -= len(deliveries)
+
+    return len(failed)
+
+
+async def move_to_dead_letters(
+    session: AsyncSession,
+    requests: list[tables.HandlerNotificationRequest],
+    errors: dict[UUID, str | None]
+):
+    moved_ids = await lease.complete(session, tables.HandlerNotificationRequest, requests)
+    if not moved_ids:
+        return
+
+    now = datetime.now()
+    await session.execute(insert(tables.HandlerNotificationDeadLetter).values([
+        {
+            'id': request.id,
+            'created_at': request.created_at,
+            'failed_at': now,
+            'attempts': request.attempts,
+            'last_error': errors[request.id],
+            'handler_url': request.handler_url,
+            'handler_host': request.handler_host,
+            'batching': request.batching,
+            'trace_id': request.trace_id,
+            'data': request.data
+        }
+        for request in requests
+        if request.id in moved_ids
+    ]))
+    logger.warning(f'moved {len(moved_ids)} undelivered notification(s) to dead letters')
+
+
+# Возвращает уведомления из dead letters в очередь одним запросом
+async def requeue_dead_letters(handler_url: str | None = None) -> int:
+    dead_letter = tables.HandlerNotificationDeadLetter
+    request = tables.HandlerNotificationRequest
+    now = datetime.now()
+
+    moved = (
+        delete(dead_letter)
+        .where(*([dead_letter.handler_url == handler_url] if handler_url is not None else []))
+        .returning(
+            dead_letter.id, dead_letter.created_at, dead_letter.handler_url,
+            dead_letter.handler_host, dead_letter.batching, dead_letter.trace_id, dead_letter.data
+        )
+        .cte('moved')
+    )
+
+    async with db.postgres.session_maker() as session, session.begin():
+        requeued = len((await session.execute(
+            insert(request)
+            .from_select(
+                [request.id, request.created_at, request.next_attempt_at, request.attempts,
+                 request.handler_url, request.handler_host, request.batching, request.trace_id, request.data],
+                select(moved.c.id, moved.c.created_at, literal(now), literal(0),
+                       moved.c.handler_url, moved.c.handler_host, moved.c.batching, moved.c.trace_id, moved.c.data)
+            )
+            .returning(request.id)
+        )).all())
+
+        if requeued:
+            await db.postgres.notify(session, request.__tablename__)
+
+    return requeued
+
+
+# Возвращает текст ошибки, или None, если уведомления доставлены
 async def notify_handler(
-    notify_request: tables.HandlerNotificationRequest,
+    notify_requests: list[tables.HandlerNotificationRequest],
     handler_client: httpx.AsyncClient
-) -> bool:
+) -> str | None:
+    handler_url = notify_requests[0].handler_url
+    # У массива уведомлений трассы разные, X-Request-Id передается только с одиночным
+    trace_id = notify_requests[0].trace_id if len(notify_requests) == 1 else None
     error_msg = None
     try:
         response = await handler_client.post(
-            url=notify_request.handler_url,
-            json=notify_request.data,
+            url=handler_url,
+            headers={tracing.REQUEST_ID_HEADER: trace_id} if trace_id is not None else None,
+            json=(
+                [r.data for r in notify_requests]
+                if notify_requests[0].batching else
+                notify_requests[0].data
+            ),
             timeout=settings.handler_notification_timeout
         )
         if response.status_code != 200:
-            error_msg = f'got status {response.status_code} from handler "{notify_request.handler_url}"'
+            error_msg = f'got status {response.status_code} from handler "{handler_url}"'
     except httpx.ConnectError:
-        error_msg = f'couldn\'t connect to handler "{notify_request.handler_url}"'
+        error_msg = f'couldn\'t connect to handler "{handler_url}"'
+    except httpx.TimeoutException:
+        error_msg = f'handler "{handler_url}" timed out'
+    except httpx.HTTPError as e:
+        error_msg = f'error while notifying handler "{handler_url}": {str(e)}'
 
     if error_msg is not None:
         logger.warning(error_msg)
-        return False
 
-    return True
\ No newline at end of file
+    return error_msg
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import aiokafka
+import aiokafka.errors
+import psycopg
+import sqlalchemy.exc
+from typing import Any
+from datetime import datetime
+from sqlalchemy import select, delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import tables
+import tracing
+import db.postgres
+from settings import settings, pg_settings
+from . import metrics
+from .wakeup import Wakeup
+
+
+logger = logging.getLogger('bill-worker-outbox-relay-loop')
+
+
+# Ключ advisory lock: сообщения отправляет только один реле одновременно, чтобы сохранять порядок
+OUTBOX_RELAY_LOCK_KEY = 0x0b111
+
+
+# Сообщение - ключ, значение и trace_id (см. tracing)
+async def add_messages(session: AsyncSession, topic: str, messages: list[tuple[str, dict[str, Any], str | None]]):
+    if not messages:
+        return
+
+    now = datetime.now()
+    await session.execute(insert(tables.OutboxMessage).values([
+        {
+            'created_at': now,
+            'topic': topic,
+            'key': key,
+            'value': value,
+            'trace_id': trace_id
+        }
+        for key, value, trace_id in messages
+    ]))
+    await db.postgres.notify(session, tables.OutboxMessage.__tablename__)
+
+
+# Реле держит сессионный advisory lock на выделенном соединении (не из пула и без открытой транзакции),
+# остальные процессы ждут, пока он не освободится. Сообщения читаются и удаляются короткими транзакциями,
+# подтверждения kafka ожидаются без соединения с базой.
+# Если соединение с блокировкой разорвано, блокировка снимается, поэтому перед каждой пачкой оно проверяется.
+# Ошибки kafka и базы не выходят из цикла (иначе вместе с ним остановятся и остальные циклы воркера):
+# неудаленная пачка отправляется повторно с задержкой по outbox_relay_backoff
+async def outbox_relay_loop(kafka_producer: aiokafka.AIOKafkaProducer, wakeup: Wakeup):
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                pg_settings.get_url(driver=None),
+                autocommit=True
+            ) as lock_conn:
+                while not await try_lock(lock_conn):
+                    await asyncio.sleep(settings.outbox_relay_sleep_duration)
+
+                attempts = 0
+                while True:
+                    await (await lock_conn.execute('SELECT 1')).fetchone()
+                    try:
+                        relayed = await relay_messages(kafka_producer)
+                    except (aiokafka.errors.KafkaError, sqlalchemy.exc.DBAPIError) as e:
+                        attempts += 1
+                        logger.warning(f'outbox relay error (attempt {attempts}): {e!r}')
+                        await asyncio.sleep(settings.outbox_relay_backoff.delay(attempts))
+                        continue
+
+                    attempts = 0
+                    if relayed < settings.outbox_relay_batch_size:
+                        await wakeup.wait(settings.outbox_relay_sleep_duration)
+        except psycopg.OperationalError as e:
+            logger.warning(f'outbox relay lock connection error: {str(e)}')
+        except Exception:
+            logger.exception('outbox relay error')
+
+        await asyncio.sleep(settings.outbox_relay_sleep_duration)
+
+
+async def try_lock(lock_conn: psycopg.AsyncConnection) -> bool:
+    row = await (await lock_conn.execute('SELECT pg_try_advisory_lock(%s::bigint)', [OUTBOX_RELAY_LOCK_KEY])).fetchone()
+    return row is not None and row[0]
+
+
+async def relay_messages(kafka_producer: aiokafka.AIOKafkaProducer) -> int:
+    async with db.postgres.session_maker() as session:
+        messages = (await session.scalars(
+            select(tables.OutboxMessage)
+            .order_by(tables.OutboxMessage.id.asc())
+            .limit(settings.outbox_relay_batch_size)
+        )).all()
+
+    if not messages:
+        return 0
+
+    sent = list[asyncio.Future]()
+    for message in messages:
+        # send только кладет сообщение в буфер продюсера, который отправляет их пачками (см. KafkaSettings)
+        sent.append(await kafka_producer.send(
+            topic=message.topic,
+            key=message.key.encode() if message.key is not None else None,
+            value=message.value,
+            headers=(
+                [(tracing.REQUEST_ID_HEADER, message.trace_id.encode())]
+                if message.trace_id is not None else None
+            )
+        ))
+
+    # Удаляем только после подтверждения доставки всей пачки: при ошибке сообщения будут отправлены повторно
+    with (
+        metrics.downstream_duration.labels('kafka').time(),
+        tracing.shared([message.trace_id for message in messages], 'kafka', messages=len(messages))
+    ):
+        # Ждем все подтверждения, чтобы ошибки остальных не остались непрочитанными
+        for result in await asyncio.gather(*sent, return_exceptions=True):
+            if isinstance(result, BaseException):
+                raise result
+
+    async with db.postgres.session_maker() as session, session.begin():
+        # Не `id <= max(id)`: строки с меньшими id могли закоммититься позже и еще не быть отправленными
+        await session.execute(
+            delete(tables.OutboxMessage)
+            .where(tables.OutboxMessage.id.in_([message.id for message in messages]))
+        )
+
+    logger.info(f'relayed {len(messages)} message(s) to kafka')
+    return len(messages)
@@ -1,134 +1,322 @@
 import logging
 import httpx
 import asyncio
-import aiokafka
-import json
 import anyio
+from typing import Any, AsyncIterator
 from uuid import uuid4
-from datetime import datetime, timedelta
-from sqlalchemy import select, update, nulls_last, or_
-from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass
+from sqlalchemy import Select, String, select, update, func, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 
 import tables
+import tracing
 import db.postgres
-from settings import settings
+from settings import settings, ConcurrencyPolicy
+from . import lease, outbox
+from .pool import WorkerPool, JobResult
+from .wakeup import Wakeup
+from .notify_handlers import destination_of, first_attempt_at
 
 
 logger = logging.getLogger('bill-worker-payments-polling-loop')
 
 
-# У нас не используется веб-хук для оповещений от Yookassa, нет доменного имени
-async def payments_polling_loop(yookassa_client: httpx.AsyncClient, kafka_producer: aiokafka.AIOKafkaProducer):
-    limiter = anyio.CapacityLimiter(settings.payments_polling_loop_concurrency)
-
-    async def check_for_payment():
-        async with limiter:
-            async with db.postgres.session_maker() as session:
-                request = await session.scalar(
-                    select(tables.PaymentRequest)
-                    .where(or_(
-                        tables.PaymentRequest.processed_at.is_(None),
-                        tables.PaymentRequest.processed_at < (datetime.now() - timedelta(seconds=settings.payments_polling_loop_sleep_duration))
-                    ))
-                    .order_by(nulls_last(tables.PaymentRequest.processed_at.asc()))
-                    .with_for_update(skip_locked=True)
-                    .limit(1)
-                )
-
-                if request:
-                    if await update_payment_status(request, yookassa_client, kafka_producer):
-                        await session.delete(request)
-                    else:
-                        await session.execute(
-                            update(tables.PaymentRequest)
-                            .where(tables.PaymentRequest.id == request.id)
-                            .values({tables.PaymentRequest.processed_at: datetime.now()})
-                        )
-
-                    await session.commit()
-                    return
-
-            await asyncio.sleep(settings.payments_polling_loop_sleep_duration)
+class YookassaRequestError(Exception):
+    ...
+
+
+@dataclass(frozen=True)
+class PaymentStatus:
+    status: tables.payment.Status
+    cancellation_reason: str | None
+
+
+# Если включен веб-хук Yookassa (settings.yookassa_webhook_enabled), опрос остается для сверки
+async def payments_polling_loop(yookassa_client: httpx.AsyncClient, wakeup: Wakeup, concurrency: ConcurrencyPolicy):
+    batch_size = settings.payments_polling_loop_batch_size
+
+    async def check_for_payments() -> JobResult:
+        claimed = await lease.claim_loading(tables.PaymentRequest, with_payment, limit=batch_size)
+        if not claimed:
+            return JobResult(claimed=0)
+
+        return await update_payments_status([(r, p) for r, p in claimed], yookassa_client)
 
     async with anyio.create_task_group() as tg:
-        while True:
-            async with limiter:
-                tg.start_soon(check_for_payment)
-            await asyncio.sleep(0)
+        if settings.payments_list_resolution_enabled:
+            tg.start_soon(payments_list_resolution_loop, yookassa_client)
 
+        await WorkerPool(
+            name='payments',
+            queue=tables.PaymentRequest.__tablename__,
+            policy=concurrency,
+            job=check_for_payments,
+            depth=lambda: lease.depth(tables.PaymentRequest, concurrency.max * batch_size * 2),
+            job_size=batch_size,
+            wakeup=wakeup,
+            sleep_duration=settings.payments_polling_loop_sleep_duration
+        ).run()
+
+
+def with_payment(
+    payment_request: type[tables.PaymentRequest]
+) -> Select[tuple[tables.PaymentRequest, tables.Payment]]:
+    return (
+        select(payment_request, tables.Payment)
+        .join(tables.Payment, tables.Payment.id == payment_request.payment_id)
+    )
+
+
+# Вместо запроса на каждый платеж, постранично читаем список завершенных платежей Yookassa
+# и завершаем все найденные одним батчем.
+# Окно списка движется: от начала прошлого просмотра минус payments_list_resolution_lookback
+# (но не раньше самого старого ожидающего платежа). Платежи, ожидающие дольше lookback (в том числе брошенные),
+# завершаются запросами по отдельным платежам (payments_polling_loop), они остаются запасным вариантом
+async def payments_list_resolution_loop(yookassa_client: httpx.AsyncClient):
+    scanned_at: datetime | None = None
+    while True:
+        scanned_at = await resolve_payments_from_list(yookassa_client, scanned_at)
+        await asyncio.sleep(settings.payments_list_resolution_interval)
+
+
+# scanned_at - начало прошлого полностью прочитанного списка (None - при старте).
+# Возвращает начало этого просмотра, или прежнее значение, если список прочитать не удалось
+async def resolve_payments_from_list(yookassa_client: httpx.AsyncClient, scanned_at: datetime | None) -> datetime | None:
+    now = datetime.now()
 
-# Использовался бы и при получении уведомлений через веб-хук
-async def update_payment_status(
-    payment_request: tables.PaymentRequest,
-    yookassa_client: httpx.AsyncClient,
-    kafka_producer: aiokafka.AIOKafkaProducer
-) -> bool:
     async with db.postgres.session_maker() as session:
-        payment = (await session.execute(
-            select(tables.Payment)
-            .where(tables.Payment.id == payment_request.payment_id)
-        )).scalar_one()
-
-    # https://yookassa.ru/developers/api#get_payments_list
-    response = await yookassa_client.get(
-        url=f'/v3/payments/{payment.external_id}',
+        oldest_created_at = await session.scalar(
+            select(func.min(tables.Payment.created_at))
+            .join(tables.PaymentRequest, tables.PaymentRequest.payment_id == tables.Payment.id)
+        )
+
+    if oldest_created_at is None:
+        return now
+
+    created_since = max(oldest_created_at, now - timedelta(seconds=settings.payments_list_resolution_max_age))
+    if scanned_at is not None:
+        created_since = max(created_since, scanned_at - timedelta(seconds=settings.payments_list_resolution_lookback))
+    # Платеж в Yookassa создается раньше, чем мы сохраняем его у себя, плюс возможная разница часов
+    created_since -= timedelta(seconds=settings.payments_list_resolution_margin)
+
+    statuses = dict[str, PaymentStatus]()
+    try:
+        for yookassa_status in ('succeeded', 'canceled'):
+            async for yookassa_payment_data in list_payments(yookassa_client, yookassa_status, created_since):
+                if (status := parse_payment_status(yookassa_payment_data)) is not None:
+                    statuses[yookassa_payment_data['id']] = status
+    except YookassaRequestError as e:
+        logger.warning(str(e))
+    else:
+        scanned_at = now
+
+    if not statuses:
+        return scanned_at
+
+    claimed = await lease.claim_loading(
+        tables.PaymentRequest,
+        with_payment,
+        len(statuses),
+        tables.PaymentRequest.payment_id.in_(
+            select(tables.Payment.id)
+            # Один параметр-массив: число id не ограничено лимитом параметров запроса
+            .where(tables.Payment.external_id == any_(
+                bindparam('external_ids', list(statuses), type_=ARRAY(String))
+            ))
+        ),
+        only_due=False
     )
-    assert response.status_code == 200, response.text
-    yookassa_payment_data = response.json()
+    if not claimed:
+        return scanned_at
+
+    logger.info(f'resolved {len(claimed)} payment(s) from the yookassa payments list')
+    await finalize_payments([(r, p, statuses[p.external_id]) for r, p in claimed], [])
+    return scanned_at
+
+
+async def list_payments(
+    yookassa_client: httpx.AsyncClient,
+    status: str,
+    created_since: datetime
+) -> AsyncIterator[dict[str, Any]]:
+    params: dict[str, str | int] = {
+        'status': status,
+        'created_at.gte': created_since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        'limit': 100
+    }
+
+    while True:
+        # https://yookassa.ru/developers/api#get_payments_list
+        try:
+            response = await yookassa_client.get(url='/v3/payments', params=params)
+        except httpx.HTTPError as e:
+            raise YookassaRequestError(f'couldn\'t get yookassa payments list: {str(e)}')
+
+        if response.status_code != 200:
+            raise YookassaRequestError(
+                f'got status code {response.status_code} for yookassa payments list: {response.text}'
+            )
+
+        response_json = response.json()
+        for item in response_json['items']:
+            yield item
 
-    if yookassa_payment_data['status'] == 'pending':
-        return False
+        # Курсор None передавать нельзя, вернется пустой список (см. tests/yookassa_expectations/test_payment_list.py)
+        if (next_cursor := response_json.get('next_cursor')) is None:
+            return
+        params['cursor'] = next_cursor
 
+
+async def update_payments_status(
+    claimed: list[tuple[tables.PaymentRequest, tables.Payment]],
+    yookassa_client: httpx.AsyncClient
+) -> JobResult:
+    statuses = dict[str, PaymentStatus | None]()
+    failed = 0
+
+    async def fetch(request: tables.PaymentRequest, payment: tables.Payment):
+        nonlocal failed
+        with tracing.trace(request.trace_id, 'worker.payment_check', payment_id=str(payment.id)):
+            try:
+                statuses[payment.external_id] = await fetch_payment_status(payment.external_id, yookassa_client)
+            except YookassaRequestError as e:
+                logger.warning(str(e))
+                statuses[payment.external_id] = None
+                failed += 1
+
+    async with anyio.create_task_group() as tg:
+        for request, payment in claimed:
+            tg.start_soon(fetch, request, payment)
+
+    finished = [(r, p, s) for r, p in claimed if (s := statuses[p.external_id]) is not None]
+    with tracing.shared([r.trace_id for r, _ in claimed], 'worker.payments_finalize', payments=len(claimed)):
+        await finalize_payments(finished, [(r, p) for r, p in claimed if statuses[p.external_id] is None])
+
+    return JobResult(claimed=len(claimed), failed=failed, retried=len(claimed) - len(finished) - failed)
+
+
+# None - платеж еще не завершен
+async def fetch_payment_status(external_id: str, yookassa_client: httpx.AsyncClient) -> PaymentStatus | None:
+    # https://yookassa.ru/developers/api#get_payment
+    try:
+        with tracing.span('yookassa', endpoint='GET /v3/payments/{id}'):
+            response = await yookassa_client.get(url=f'/v3/payments/{external_id}')
+    except httpx.HTTPError as e:
+        raise YookassaRequestError(f'couldn\'t get yookassa payment {external_id}: {str(e)}')
+
+    if response.status_code != 200:
+        raise YookassaRequestError(
+            f'got status code {response.status_code} for yookassa payment {external_id}: {response.text}'
+        )
+
+    return parse_payment_status(response.json())
+
+
+def parse_payment_status(yookassa_payment_data: dict[str, Any]) -> PaymentStatus | None:
     status = yookassa_payment_data['status']
 
+    if status == 'pending':
+        return None
+
     # https://yookassa.ru/developers/payment-acceptance/getting-started/payment-process#payment-statuses
     # Не должно происходить
-    # 'pending' отлавливаем по стэку выше
+    # 'pending' отлавливаем выше
     # 'waiting_for_capture' быть не может, так как не используем подтверждение оплаты
     if status not in ('succeeded', 'canceled'):
         logger.warning(f'yookassa payment {yookassa_payment_data['id']} has unknown status "{status}", ignoring')
-        return False
+        return None
 
     if status == 'canceled':  # Оба варианта верны. Yookassa использует `canceled`, мы - `cancelled`
         status = 'cancelled'
 
-    async with db.postgres.session_maker() as session, session.begin():
-        cancellation_details = yookassa_payment_data.get('cancellation_details')
-        cancellation_reason = cancellation_details['reason'] if cancellation_details else None
-
-        await session.execute(
-            update(tables.Payment)
-            .values({
-                tables.Payment.status: status,
-                tables.Payment.external_cancellation_reason: cancellation_reason
-            })
-            .where(tables.Payment.id == payment.id)
-        )
+    cancellation_details = yookassa_payment_data.get('cancellation_details')
+    return PaymentStatus(
+        status=status,
+        cancellation_reason=cancellation_details['reason'] if cancellation_details else None
+    )
 
-    data = {
-        'id': str(payment.id),
-        'status': status,
-        'extra_data': payment_request.extra_data
-    }
 
-    # TODO Использовать Transactional Producer? https://aiokafka.readthedocs.io/en/stable/producer.html#transactional-producer
-    await kafka_producer.send_and_wait(
-        topic='payment',
-        value=json.dumps(data).encode()
+# Следующая проверка незавершенного платежа - по его возрасту (см. settings.payments_polling_curve),
+# но не позже, чем Yookassa должна отменить неподтвержденный платеж
+def next_check_at(request: tables.PaymentRequest, payment: tables.Payment, now: datetime) -> datetime:
+    if settings.yookassa_webhook_enabled:
+        delay = settings.payments_reconciliation_backoff.delay(request.attempts)
+    else:
+        delay = settings.payments_polling_curve.delay((now - payment.created_at).total_seconds())
+
+    next_check = now + timedelta(seconds=delay)
+    expired_at = payment.created_at + timedelta(
+        seconds=settings.payments_confirmation_expiry + settings.payments_confirmation_expiry_margin
     )
-    logger.info(f'sent notification about payment {payment.id} to the "payment" topic')
+    return min(next_check, expired_at) if now < expired_at else next_check
+
+
+# Используется и при получении уведомлений через веб-хук (запрос платежа переводится в начало очереди)
+async def finalize_payments(
+    finished: list[tuple[tables.PaymentRequest, tables.Payment, PaymentStatus]],
+    not_finished: list[tuple[tables.PaymentRequest, tables.Payment]]
+):
+    now = datetime.now()
 
-    if payment_request.handler_url:
-        async with db.postgres.session_maker() as session, session.begin():
+    async with db.postgres.session_maker() as session, session.begin():
+        await lease.release_at(session, tables.PaymentRequest, [
+            (request, next_check_at(request, payment, now))
+            for request, payment in not_finished
+        ])
+
+        # Если аренду успел забрать другой воркер, оставляем запрос ему
+        completed_ids = await lease.complete(session, tables.PaymentRequest, [r for r, _, _ in finished])
+        completed = [(r, p, s) for r, p, s in finished if r.id in completed_ids]
+        if not completed:
+            return
+
+        # ORM bulk update по первичному ключу - один executemany на весь батч
+        await session.execute(update(tables.Payment), [
+            {
+                'id': payment.id,
+                'status': status.status,
+                'external_cancellation_reason': status.cancellation_reason
+            }
+            for _, payment, status in completed
+        ])
+        # Сбрасывает кэш статусов в API (см. services.status)
+        await db.postgres.notify_ids(session, tables.Payment.__tablename__, [payment.id for _, payment, _ in completed])
+
+        data = {
+            request.id: {
+                'id': str(payment.id),
+                'status': status.status,
+                'extra_data': request.extra_data
+            }
+            for request, payment, status in completed
+        }
+
+        # Сообщение в kafka отправится из outbox, в той же транзакции, что и изменение статуса
+        await outbox.add_messages(session, 'payment', [
+            (str(payment.id), data[request.id], request.trace_id)
+            for request, payment, _ in completed
+        ])
+
+        notifications = [
+            {
+                'id': uuid4(),
+                'created_at': now,
+                'next_attempt_at': first_attempt_at(request.handler_batching, now),
+                'attempts': 0,
+                'handler_url': request.handler_url,
+                'handler_host': destination_of(request.handler_url),
+                'batching': request.handler_batching,
+                'trace_id': request.trace_id,
+                'data': data[request.id]
+            }
+            for request, _, _ in completed
+            if request.handler_url
+        ]
+        if notifications:
             await session.execute(
                 insert(tables.HandlerNotificationRequest)
-                .values({
-                    tables.HandlerNotificationRequest.id: uuid4(),
-                    tables.HandlerNotificationRequest.created_at: datetime.now(),
-                    tables.HandlerNotificationRequest.handler_url: payment_request.handler_url,
-                    tables.HandlerNotificationRequest.data: data
-                })
+                .values(notifications)
                 .on_conflict_do_nothing()
             )
-
-    return True
\ No newline at end of file
+            await db.postgres.notify(session, tables.HandlerNotificationRequest.__tablename__)
@@ -0,0 +1,157 @@
+import math
+import time
+import asyncio
+import logging
+import anyio
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import db.postgres
+from settings import settings, ConcurrencyPolicy
+from . import metrics
+from .wakeup import Wakeup
+from .lanes import Lane
+
+
+logger = logging.getLogger('bill-worker-pool')
+
+
+@dataclass(frozen=True)
+class JobResult:
+    claimed: int  # 0 - очередь пуста
+    failed: int = 0  # Ошибки (внешнего сервиса и т.п.), строки возвращены в очередь
+    retried: int = 0  # Еще не готовы (например, платеж не завершен), строки возвращены в очередь
+    # Строки переданы фоновым задачам, которые сообщат результат сами (WorkerPool.report).
+    # Тогда длительность задачи - только время аренды
+    dispatched: bool = False
+
+    @property
+    def done(self) -> int:
+        return self.claimed - self.failed - self.retried
+
+
+# Пулы запущенных циклов по имени, для просмотра текущей конкурентности и длины очереди по полосам
+pools = dict[str, 'WorkerPool']()
+
+
+# Фиксированный набор из policy.max долгоживущих обработчиков, из которых работают первые `concurrency`.
+# Раз в worker_concurrency_adjust_interval конкурентность пересчитывается (AIMD):
+# - при доле ошибок выше error_rate_limit или p95 длительности выше latency_target - уменьшается в decrease_factor раз
+# - если очередь (depth, в строках) больше, чем успеют забрать работающие обработчики, - растет на increase_step,
+#   но только пока в пуле соединений с БД не используются overflow соединения
+# - если очередь пуста - уменьшается на 1
+class WorkerPool:
+    def __init__(
+        self,
+        name: str,
+        queue: str,  # Имя таблицы очереди, для метрик
+        policy: ConcurrencyPolicy,
+        job: Callable[[], Awaitable[JobResult]],
+        depth: Callable[[], Awaitable[dict[Lane, int]]],
+        job_size: int,  # Сколько строк забирает одна задача
+        wakeup: Wakeup,
+        sleep_duration: float
+    ):
+        self.name = name
+        self._queue = queue
+        self.policy = policy
+        self.concurrency = policy.min
+        self.depths: dict[Lane, int] = {}
+        self._job = job
+        self._depth = depth
+        self._job_size = job_size
+        self._wakeup = wakeup
+        self._sleep_duration = sleep_duration
+        self._resized = asyncio.Event()
+        self._latencies = list[float]()
+        self._claimed = 0
+        self._failed = 0
+
+    async def run(self):
+        pools[self.name] = self
+        metrics.concurrency.labels(self.name).set(self.concurrency)
+        try:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(self._control)
+                for index in range(self.policy.max):
+                    tg.start_soon(self._consume, index)
+        finally:
+            del pools[self.name]
+
+    async def _consume(self, index: int):
+        while True:
+            if index >= self.concurrency:
+                await self._resized.wait()
+                continue
+
+            started = time.monotonic()
+            metrics.busy.labels(self.name).inc()
+            try:
+                result = await self._job()
+            finally:
+                metrics.busy.labels(self.name).dec()
+
+            if not result.claimed:
+                await self._wakeup.wait(self._sleep_duration)
+                continue
+
+            duration = time.monotonic() - started
+            self._latencies.append(duration)
+            metrics.job_duration.labels(self.name).observe(duration)
+
+            if not result.dispatched:
+                self._claimed += result.claimed
+                self._failed += result.failed
+                self.report(result)
+
+    # Результат обработки строк, в том числе переданных фоновым задачам (JobResult.dispatched).
+    # Результаты фоновых задач в пересчет конкурентности не входят
+    def report(self, result: JobResult):
+        metrics.requests_processed.labels(self.name, 'done').inc(result.done)
+        metrics.requests_processed.labels(self.name, 'retry').inc(result.retried)
+        metrics.requests_processed.labels(self.name, 'error').inc(result.failed)
+
+    async def _control(self):
+        while True:
+            await asyncio.sleep(settings.worker_concurrency_adjust_interval)
+            # Без длины очереди конкурентность не пересчитывается, обработка продолжается с текущей
+            try:
+                self.depths = await self._depth()
+            except Exception:
+                logger.exception(f'{self.name}: failed to get queue depth')
+                continue
+            for lane, depth in self.depths.items():
+                metrics.queue_depth.labels(self._queue, lane).set(depth)
+            self._resize(sum(self.depths.values()))
+
+    def _resize(self, depth: int):
+        latencies, self._latencies = sorted(self._latencies), []
+        claimed, failed, self._claimed, self._failed = self._claimed, self._failed, 0, 0
+
+        p95 = latencies[math.ceil(len(latencies) * 0.95) - 1] if latencies else 0.0
+        error_rate = failed / claimed if claimed else 0.0
+        pool = db.postgres.engine.pool
+        db_pressure = pool.checkedout() > pool.size()  # type: ignore[attr-defined]
+
+        concurrency = self.concurrency
+        if error_rate > self.policy.error_rate_limit or p95 > self.policy.latency_target:
+            concurrency = math.floor(concurrency * self.policy.decrease_factor)
+        # Без завершенных за интервал задач латентность неизвестна - не растем
+        elif depth > concurrency * self._job_size and latencies and not db_pressure:
+            concurrency += self.policy.increase_step
+        elif depth == 0:
+            concurrency -= 1
+        concurrency = max(self.policy.min, min(self.policy.max, concurrency))
+
+        if concurrency == self.concurrency:
+            return
+
+        logger.info(
+            f'{self.name}: concurrency {self.concurrency} -> {concurrency} '
+            f'(depth {depth} {self.depths}, p95 {p95:.2f}s, errors {error_rate:.0%}, db pool {pool.checkedout()}/{pool.size()})'  # type: ignore[attr-defined]
+        )
+        self.concurrency = concurrency
+        metrics.concurrency.labels(self.name).set(concurrency)
+
+        resized, self._resized = self._resized, asyncio.Event()
+        resized.set()
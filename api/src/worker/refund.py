@@ -1,89 +1,79 @@
 import logging
 import httpx
-import asyncio
-import json
-import aiokafka
-import anyio
 from uuid import uuid4
-from datetime import datetime, timedelta
-from sqlalchemy import select, update, nulls_last, or_
+from datetime import datetime
+from sqlalchemy import Select, select, update
 from sqlalchemy.dialects.postgresql import insert
 
 import tables
+import tracing
 import db.postgres
-from settings import settings
+from settings import settings, ConcurrencyPolicy
+from . import lease, outbox
+from .pool import WorkerPool, JobResult
+from .wakeup import Wakeup
+from .notify_handlers import destination_of, first_attempt_at
 
 
 logger = logging.getLogger('bill-worker-refund-loop')
 
 
-async def refund_loop(yookassa_client: httpx.AsyncClient, kafka_producer: aiokafka.AIOKafkaProducer):
-    limiter = anyio.CapacityLimiter(settings.refund_loop_concurrency)
-
-    async def check_for_refund():
-        async with limiter:
-            async with db.postgres.session_maker() as session:
-                request = await session.scalar(
-                    select(tables.RefundRequest)
-                    .where(or_(
-                        tables.RefundRequest.processed_at.is_(None),
-                        tables.RefundRequest.processed_at < (datetime.now() - timedelta(seconds=settings.refund_loop_sleep_duration))
-                    ))
-                    .order_by(nulls_last(tables.RefundRequest.processed_at.asc()))
-                    .with_for_update(skip_locked=True)
-                    .limit(1)
-                )
-
-                if request:
-                    if await refund_payment(request, kafka_producer, yookassa_client):
-                        await session.delete(request)
-                    else:
-                        await session.execute(
-                            update(tables.RefundRequest)
-                            .where(tables.RefundRequest.id == request.id)
-                            .values({tables.RefundRequest.processed_at: datetime.now()})
-                        )
-
-                    await session.commit()
-                    return
-
-            await asyncio.sleep(settings.refund_loop_sleep_duration)
-
-
-    async with anyio.create_task_group() as tg:
-        while True:
-            async with limiter:
-                tg.start_soon(check_for_refund)
-            await asyncio.sleep(0)
+async def refund_loop(yookassa_client: httpx.AsyncClient, wakeup: Wakeup, concurrency: ConcurrencyPolicy):
+    async def check_for_refund() -> JobResult:
+        claimed = await lease.claim_loading(tables.RefundRequest, with_refund_and_payment, limit=1)
+        if not claimed:
+            return JobResult(claimed=0)
+
+        refund_request, refund, payment = claimed[0]
+        with tracing.trace(refund_request.trace_id, 'worker.refund', refund_id=str(refund.id)):
+            return await refund_payment(refund_request, refund, payment, yookassa_client)
+
+    await WorkerPool(
+        name='refunds',
+        queue=tables.RefundRequest.__tablename__,
+        policy=concurrency,
+        job=check_for_refund,
+        depth=lambda: lease.depth(tables.RefundRequest, concurrency.max * 2),
+        job_size=1,
+        wakeup=wakeup,
+        sleep_duration=settings.refund_loop_sleep_duration
+    ).run()
+
+
+def with_refund_and_payment(
+    refund_request: type[tables.RefundRequest]
+) -> Select[tuple[tables.RefundRequest, tables.Refund, tables.Payment]]:
+    return (
+        select(refund_request, tables.Refund, tables.Payment)
+        .join(tables.Refund, tables.Refund.id == refund_request.refund_id)
+        .join(tables.Payment, tables.Payment.id == tables.Refund.payment_id)
+    )
 
 
 async def refund_payment(
     refund_request: tables.RefundRequest,
-    kafka_producer: aiokafka.AIOKafkaProducer,
+    refund: tables.Refund,
+    payment: tables.Payment,
     yookassa_client: httpx.AsyncClient
-) -> bool:
-    async with db.postgres.session_maker() as session:
-        refund = (await session.execute(
-            select(tables.Refund)
-            .where(tables.Refund.id == refund_request.refund_id)
-        )).scalar_one()
-        payment = (await session.execute(
-            select(tables.Payment)
-            .where(tables.Payment.id == refund.payment_id)
-        )).scalar_one()
-
+) -> JobResult:
     # https://yookassa.ru/developers/api#create_refund
-    response = await yookassa_client.post(
-        url='/v3/refunds',
-        headers={'Idempotence-Key': str(refund_request.id)},  # !
-        json={
-            'payment_id': payment.external_id,
-            'amount': {'value': str(refund.amount), 'currency': refund.currency},
-            'metadata': {
-                'refund_id': str(refund.id)
-            }
-        }
-    )
+    try:
+        with tracing.span('yookassa', endpoint='POST /v3/refunds'):
+            response = await yookassa_client.post(
+                url='/v3/refunds',
+                headers={'Idempotence-Key': str(refund_request.id)},  # !
+                json={
+                    'payment_id': payment.external_id,
+                    'amount': {'value': str(refund.amount), 'currency': refund.currency},
+                    'metadata': {
+                        'refund_id': str(refund.id)
+                    }
+                }
+            )
+    except httpx.HTTPError as e:
+        # Повтор с тем же Idempotence-Key безопасен, даже если Yookassa успела создать возврат
+        logger.warning(f'couldn\'t create yookassa refund for refund {refund.id}: {str(e)}')
+        return await release(refund_request)
 
     response_json = response.json()
 
@@ -96,18 +86,29 @@ async def refund_payment(
         cancellation_reason = response_json['description']
     else:
         logger.warning(f'unexpected http status from "refund": {response.status_code}, ignoring')
-        return False
+        return await release(refund_request)
 
     # https://yookassa.ru/developers/api#refund_object_status
     # Не должно быть других статусов, проверяем на всякий случай
     if status not in ('succeeded', 'canceled'):
         logger.warning(f'yookassa refund {response_json['id']} has unknown status "{status}", ignoring')
-        return False
+        return await release(refund_request)
 
     if status == 'canceled':  # Оба варианта верны. Yookassa использует `canceled`, мы - `cancelled`
         status = 'cancelled'
 
+    data = {
+        'id': str(refund.id),
+        'status': status,
+        'external_cancellation_reason': cancellation_reason,
+        'extra_data': refund_request.extra_data
+    }
+
     async with db.postgres.session_maker() as session, session.begin():
+        # Если аренду успел забрать другой воркер, оставляем запрос ему. Это не ошибка, а повтор
+        if not await lease.complete(session, tables.RefundRequest, [refund_request]):
+            return JobResult(claimed=1, retried=1)
+
         await session.execute(
             update(tables.Refund)
             .where(tables.Refund.id == refund.id)
@@ -117,31 +118,35 @@ async def refund_payment(
                 tables.Refund.external_cancellation_reason: cancellation_reason
             })
         )
+        # Сбрасывает кэш статусов в API (см. services.status)
+        await db.postgres.notify(session, tables.Refund.__tablename__, str(refund.id))
 
-    data = {
-        'id': str(refund.id),
-        'status': status,
-        'external_cancellation_reason': cancellation_reason,
-        'extra_data': refund_request.extra_data
-    }
-
-    await kafka_producer.send_and_wait(
-        topic='refund',
-        value=json.dumps(data).encode()
-    )
-    logger.info(f'sent notification about refund {refund.id} to the "refund" topic')
+        # Сообщение в kafka отправится из outbox, в той же транзакции, что и изменение статуса
+        await outbox.add_messages(session, 'refund', [(str(refund.id), data, refund_request.trace_id)])
 
-    if refund_request.handler_url:
-        async with db.postgres.session_maker() as session, session.begin():
+        if refund_request.handler_url:
+            now = datetime.now()
             await session.execute(
                 insert(tables.HandlerNotificationRequest)
                 .values({
                     tables.HandlerNotificationRequest.id: uuid4(),
-                    tables.HandlerNotificationRequest.created_at: datetime.now(),
+                    tables.HandlerNotificationRequest.created_at: now,
+                    tables.HandlerNotificationRequest.next_attempt_at: first_attempt_at(refund_request.handler_batching, now),
+                    tables.HandlerNotificationRequest.attempts: 0,
                     tables.HandlerNotificationRequest.handler_url: refund_request.handler_url,
+                    tables.HandlerNotificationRequest.handler_host: destination_of(refund_request.handler_url),
+                    tables.HandlerNotificationRequest.batching: refund_request.handler_batching,
+                    tables.HandlerNotificationRequest.trace_id: refund_request.trace_id,
                     tables.HandlerNotificationRequest.data: data
                 })
                 .on_conflict_do_nothing()
             )
+            await db.postgres.notify(session, tables.HandlerNotificationRequest.__tablename__)
 
-    return True
\ No newline at end of file
+    return JobResult(claimed=1)
+
+
+async def release(refund_request: tables.RefundRequest) -> JobResult:
+    async with db.postgres.session_maker() as session, session.begin():
+        await lease.release(session, tables.RefundRequest, [refund_request], settings.refund_loop_backoff)
+    return JobResult(claimed=1, failed=1)
@@ -0,0 +1,78 @@
+import time
+import signal
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing.process import BaseProcess
+
+from settings import settings
+from . import Role, run
+from .lease import Partition
+
+
+logger = logging.getLogger('bill-worker-supervisor')
+
+
+def configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s'
+    )
+    import httpx  # noqa
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+
+def run_process(roles: list[Role], partition: Partition, concurrency: int | None):
+    configure_logging()
+    try:
+        asyncio.run(run(roles, partition, concurrency))
+    except KeyboardInterrupt:
+        ...
+
+
+# Запускает processes процессов воркера, каждый со своим разделом очередей, и перезапускает упавшие.
+# Процессы запускаются через spawn: у каждого свой event loop, пул соединений и клиенты
+def supervise(processes: int, roles: list[Role], concurrency: int | None):
+    configure_logging()
+
+    context = multiprocessing.get_context('spawn')
+    children = dict[int, BaseProcess]()
+
+    def start(index: int):
+        process = children[index] = context.Process(
+            target=run_process,
+            args=(roles, Partition(index=index, count=processes), concurrency),
+            name=f'bill-worker-{index}'
+        )
+        process.start()
+        logger.info(f'started worker process {index} (pid {process.pid})')
+
+    stopping = False
+
+    def stop(signum: int, frame: object):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(processes):
+        start(index)
+
+    try:
+        while not stopping:
+            multiprocessing.connection.wait([p.sentinel for p in children.values()], timeout=1.0)
+
+            for index, process in list(children.items()):
+                if process.is_alive() or stopping:
+                    continue
+                # Пока процесс перезапускается, его раздел забирают остальные (см. lease.overdue)
+                logger.warning(f'worker process {index} exited with code {process.exitcode}, restarting')
+                time.sleep(settings.worker_restart_delay)
+                start(index)
+    finally:
+        for process in children.values():
+            process.terminate()
+        for process in children.values():
+            process.join()
@@ -0,0 +1,17 @@
+import asyncio
+import anyio
+
+
+# Будит простаивающие задачи цикла, когда в очереди появилась работа.
+# Если уведомление потерялось, задачи все равно проснутся по таймауту
+class Wakeup:
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def set(self, payload: str = ''):
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def wait(self, timeout: float):
+        with anyio.move_on_after(timeout):
+            await self._event.wait()
@@ -1,9 +1,11 @@
 import sys
+import uuid
 import pathlib
 import asyncio
 import pytest
 import httpx
 import aiokafka
+from typing import Any, Awaitable, Callable
 from asgi_lifespan import LifespanManager
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent.parent/'src'))
@@ -81,4 +83,40 @@ async def run_migrations():
 
         command.upgrade(alembic_cfg, 'head')
 
-        yield
\ No newline at end of file
+        yield
+
+
+# Тело POST /api/v1/payment, оплачиваемое тестовой картой. Поля можно переопределить
+@pytest.fixture
+def payment_body() -> Callable[..., dict[str, Any]]:
+    def make(user_id: uuid.UUID | None = None, card_number: str = '5555555555554444', **fields: Any) -> dict[str, Any]:
+        return {
+            'user_id': str(user_id or uuid.uuid4()),
+            'return_url': 'https://example.com',
+            'amount': '100.00',
+            'currency': 'RUB',
+            'card_data': {
+                # https://yookassa.ru/developers/payment-acceptance/testing-and-going-live/testing#test-bank-card
+                'number': card_number,  # 5555555555554444 - без подтверждения
+                'expiry_year': '2030',
+                'expiry_month': '12',
+                'cardholder': 'XXX',
+                'csc': '543'
+            }
+        } | fields
+
+    return make
+
+
+# Создает платеж и возвращает его id
+@pytest.fixture
+def create_payment(
+    api_client: httpx.AsyncClient,
+    payment_body: Callable[..., dict[str, Any]]
+) -> Callable[..., Awaitable[str]]:
+    async def create(**kwargs: Any) -> str:
+        response = await api_client.post('/api/v1/payment', json=payment_body(**kwargs))
+        assert response.status_code == 200, response.text
+        return response.json()['payment_id']
+
+    return create
@@ -0,0 +1,79 @@
+import httpx
+import uuid
+import asyncio
+from typing import Any, Awaitable, Callable
+from sqlalchemy import select, func
+
+import db.postgres
+import tables
+
+
+async def count_payments(user_id: uuid.UUID) -> int:
+    async with db.postgres.session_maker() as session:
+        return await session.scalar(select(func.count()).where(tables.Payment.user_id == user_id)) or 0
+
+
+async def test_payment_replay(api_client: httpx.AsyncClient, payment_body: Callable[..., dict[str, Any]]):
+    user_id = uuid.uuid4()
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+
+    first = await api_client.post('/api/v1/payment', json=payment_body(user_id), headers=headers)
+    assert first.status_code == 200, first.text
+
+    second = await api_client.post('/api/v1/payment', json=payment_body(user_id), headers=headers)
+    assert second.status_code == 200, second.text
+    assert second.json() == first.json()
+
+    assert await count_payments(user_id) == 1
+
+
+async def test_payment_without_key(api_client: httpx.AsyncClient, payment_body: Callable[..., dict[str, Any]]):
+    user_id = uuid.uuid4()
+
+    for _ in range(2):
+        response = await api_client.post('/api/v1/payment', json=payment_body(user_id))
+        assert response.status_code == 200, response.text
+
+    assert await count_payments(user_id) == 2
+
+
+async def test_key_reused_with_other_params(api_client: httpx.AsyncClient, payment_body: Callable[..., dict[str, Any]]):
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+
+    response = await api_client.post('/api/v1/payment', json=payment_body(uuid.uuid4()), headers=headers)
+    assert response.status_code == 200, response.text
+
+    response = await api_client.post('/api/v1/payment', json=payment_body(uuid.uuid4()), headers=headers)
+    assert response.status_code == 422, response.text
+
+
+async def test_concurrent_duplicates(api_client: httpx.AsyncClient, payment_body: Callable[..., dict[str, Any]]):
+    user_id = uuid.uuid4()
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+
+    responses = await asyncio.gather(*(
+        api_client.post('/api/v1/payment', json=payment_body(user_id), headers=headers)
+        for _ in range(5)
+    ))
+
+    for response in responses:
+        assert response.status_code == 200, response.text
+    assert len({response.json()['payment_id'] for response in responses}) == 1
+
+    assert await count_payments(user_id) == 1
+
+
+async def test_refund_replay(api_client: httpx.AsyncClient, create_payment: Callable[..., Awaitable[str]]):
+    payment_id = await create_payment()
+
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+    for _ in range(2):
+        response = await api_client.post(f'/api/v1/payment/{payment_id}/refund', json={
+            'amount': '100.00',
+            'currency': 'RUB'
+        }, headers=headers)
+        assert response.status_code == 200, response.text
+
+    async with db.postgres.session_maker() as session:
+        refunds = await session.scalar(select(func.count()).where(tables.Refund.payment_id == uuid.UUID(payment_id)))
+    assert refunds == 1
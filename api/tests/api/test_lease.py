@@ -0,0 +1,126 @@
+import uuid
+from decimal import Decimal
+from datetime import datetime, timedelta
+from sqlalchemy import insert, update
+
+import db.postgres
+import tables
+import worker.lease
+from settings import settings
+
+
+# Строка очереди, которую запущенный воркер не заберет: время попытки еще не подошло
+async def create_refund_request() -> uuid.UUID:
+    now = datetime.now()
+    payment_id, refund_id, request_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+    async with db.postgres.session_maker() as session, session.begin():
+        await session.execute(insert(tables.Payment).values({
+            'id': payment_id,
+            'external_id': str(uuid.uuid4()),
+            'user_id': uuid.uuid4(),
+            'status': 'succeeded',
+            'external_cancellation_reason': None,
+            'created_at': now,
+            'amount': Decimal('100.00'),
+            'currency': 'RUB'
+        }))
+        await session.execute(insert(tables.Refund).values({
+            'id': refund_id,
+            'payment_id': payment_id,
+            'external_id': None,
+            'created_at': now,
+            'status': 'created',
+            'external_cancellation_reason': None,
+            'amount': Decimal('100.00'),
+            'currency': 'RUB'
+        }))
+        await session.execute(insert(tables.RefundRequest).values({
+            'id': request_id,
+            'created_at': now,
+            'next_attempt_at': now + timedelta(hours=1),
+            'refund_id': refund_id
+        }))
+
+    return request_id
+
+
+async def claim(request_id: uuid.UUID) -> list[tables.RefundRequest]:
+    return await worker.lease.claim(
+        tables.RefundRequest,
+        10,
+        tables.RefundRequest.id == request_id,
+        only_due=False
+    )
+
+
+async def test_claim_is_exclusive():
+    request_id = await create_refund_request()
+
+    claimed = await claim(request_id)
+    assert [request.id for request in claimed] == [request_id]
+    assert claimed[0].claimed_by == worker.lease.worker_id
+    assert claimed[0].attempts == 1
+
+    # Пока аренда не истекла, строку никто не заберет
+    assert await claim(request_id) == []
+
+
+async def expire_lease(request_id: uuid.UUID):
+    async with db.postgres.session_maker() as session, session.begin():
+        await session.execute(
+            update(tables.RefundRequest)
+            .where(tables.RefundRequest.id == request_id)
+            .values({tables.RefundRequest.lease_until: datetime.now() - timedelta(seconds=1)})
+        )
+
+
+async def test_expired_lease_is_reclaimed():
+    request_id = await create_refund_request()
+    first = await claim(request_id)
+    await expire_lease(request_id)
+
+    claimed = await claim(request_id)
+    assert [request.id for request in claimed] == [request_id]
+    assert claimed[0].attempts == 2
+    assert claimed[0].lease_token != first[0].lease_token
+
+
+async def test_lost_lease_is_not_completed():
+    request_id = await create_refund_request()
+    stale = await claim(request_id)
+
+    # Аренда истекла, и строку снова забрал тот же процесс:
+    # задача с прежней арендой не может ни завершить, ни вернуть строку в очередь
+    await expire_lease(request_id)
+    claimed = await claim(request_id)
+
+    async with db.postgres.session_maker() as session, session.begin():
+        await worker.lease.release(session, tables.RefundRequest, stale, settings.refund_loop_backoff)
+        assert await worker.lease.complete(session, tables.RefundRequest, stale) == set()
+
+    async with db.postgres.session_maker() as session, session.begin():
+        request = await session.get(tables.RefundRequest, request_id)
+        assert request is not None and request.lease_token == claimed[0].lease_token
+
+        assert await worker.lease.complete(session, tables.RefundRequest, claimed) == {request_id}
+
+
+async def test_release_schedules_retry():
+    request_id = await create_refund_request()
+    claimed = await claim(request_id)
+
+    released_at = datetime.now()
+    async with db.postgres.session_maker() as session, session.begin():
+        await worker.lease.release(session, tables.RefundRequest, claimed, settings.refund_loop_backoff)
+
+    async with db.postgres.session_maker() as session:
+        request = await session.get(tables.RefundRequest, request_id)
+    assert request is not None
+    assert request.claimed_by is None and request.lease_until is None
+    assert request.processed_at is not None and request.processed_at >= released_at
+
+    # Задержка по политике повторов (с учетом jitter)
+    policy = settings.refund_loop_backoff
+    delay = (request.next_attempt_at - released_at).total_seconds()
+    assert policy.base * (1.0 - policy.jitter) - 1.0 <= delay <= policy.base * (1.0 + policy.jitter) + 1.0
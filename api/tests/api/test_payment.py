@@ -3,29 +3,22 @@ import uuid
 import aiokafka
 import asyncio
 import json
+from typing import Any, Callable
+from sqlalchemy import select, func
+
+import db.postgres
+import tables
+from settings import settings
 
 
 async def test_successful_payment(
     api_client: httpx.AsyncClient,
     kafka_consumer: aiokafka.AIOKafkaConsumer,
+    payment_body: Callable[..., dict[str, Any]],
 ):
-    response = await api_client.post('/api/v1/payment', json={
-        'user_id': str(uuid.uuid4()),
-        'return_url': 'https://example.com',
-        'amount': '100.00',
-        'currency': 'RUB',
-        'card_data': {
-            # https://yookassa.ru/developers/payment-acceptance/testing-and-going-live/testing#test-bank-card
-            'number': '5555555555554444',  # без подтверждения
-            'expiry_year': '2030',
-            'expiry_month': '12',
-            'cardholder': 'XXX',
-            'csc': '543'
-        },
-        'extra_data': {
-            'payment_test': '💵'
-        }
-    })
+    response = await api_client.post('/api/v1/payment', json=payment_body(extra_data={
+        'payment_test': '💵'
+    }))
 
     assert response.status_code == 200, response.text
     response_json = response.json()
@@ -43,4 +36,55 @@ async def test_successful_payment(
                     'payment_test': '💵'
                 }
             }, value
-            break
\ No newline at end of file
+            break
+
+
+async def test_payment_batch(api_client: httpx.AsyncClient, payment_body: Callable[..., dict[str, Any]]):
+    user_ids = [uuid.uuid4() for _ in range(3)]
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+
+    response = await api_client.post('/api/v1/payment/batch', json=[payment_body(user_id) for user_id in user_ids], headers=headers)
+    assert response.status_code == 200, response.text
+    items = response.json()
+    assert [item['error'] for item in items] == [None, None, None], items
+
+    # Ответ - в порядке запроса
+    async with db.postgres.session_maker() as session:
+        for user_id, item in zip(user_ids, items):
+            payment = await session.get(tables.Payment, uuid.UUID(item['payment']['payment_id']))
+            assert payment is not None and payment.user_id == user_id
+
+    replay = await api_client.post('/api/v1/payment/batch', json=[payment_body(user_id) for user_id in user_ids], headers=headers)
+    assert replay.status_code == 200, replay.text
+    assert replay.json() == items
+
+
+async def test_payment_batch_partial_failure(api_client: httpx.AsyncClient, payment_body: Callable[..., dict[str, Any]]):
+    user_ids = [uuid.uuid4(), uuid.uuid4()]
+    body = [payment_body(user_ids[0]), payment_body(user_ids[1], card_number='1111')]  # Yookassa отклонит карту
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+
+    response = await api_client.post('/api/v1/payment/batch', json=body, headers=headers)
+    assert response.status_code == 200, response.text
+    items = response.json()
+    assert items[0]['error'] is None and items[0]['payment'] is not None, items
+    assert items[1]['payment'] is None and items[1]['error'] is not None, items
+
+    # Повтор создает только платежи с ошибкой, созданный возвращается как есть
+    retry = await api_client.post('/api/v1/payment/batch', json=body, headers=headers)
+    assert retry.status_code == 200, retry.text
+    assert retry.json()[0] == items[0]
+
+    async with db.postgres.session_maker() as session:
+        payments = await session.scalar(select(func.count()).where(tables.Payment.user_id.in_(user_ids)))
+    assert payments == 1
+
+
+async def test_payment_batch_size(api_client: httpx.AsyncClient, payment_body: Callable[..., dict[str, Any]]):
+    response = await api_client.post('/api/v1/payment/batch', json=[])
+    assert response.status_code == 422, response.text
+
+    response = await api_client.post('/api/v1/payment/batch', json=[
+        payment_body(uuid.uuid4()) for _ in range(settings.payment_batch_max_size + 1)
+    ])
+    assert response.status_code == 422, response.text
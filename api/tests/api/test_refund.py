@@ -3,30 +3,20 @@ import uuid
 import aiokafka
 import asyncio
 import json
+from decimal import Decimal
+from typing import Awaitable, Callable
+from sqlalchemy import select, func
+
+import db.postgres
+import tables
 
 
 async def test_successful_refund(
     api_client: httpx.AsyncClient,
     kafka_consumer: aiokafka.AIOKafkaConsumer,
+    create_payment: Callable[..., Awaitable[str]],
 ):
-    response = await api_client.post('/api/v1/payment', json={
-        'user_id': str(uuid.uuid4()),
-        'return_url': 'https://example.com',
-        'amount': '100.00',
-        'currency': 'RUB',
-        'card_data': {
-            # https://yookassa.ru/developers/payment-acceptance/testing-and-going-live/testing#test-bank-card
-            'number': '5555555555554444',  # без подтверждения
-            'expiry_year': '2030',
-            'expiry_month': '12',
-            'cardholder': 'XXX',
-            'csc': '543'
-        }
-    })
-
-    assert response.status_code == 200, response.text
-    response_json = response.json()
-    payment_id = response_json['payment_id']
+    payment_id = await create_payment()
 
     async with asyncio.timeout(20.0):
         async for msg in kafka_consumer:
@@ -44,7 +34,6 @@ async def test_successful_refund(
         }
     })
     assert response.status_code == 200, response.text
-    response_json = response.json()
 
     async with asyncio.timeout(20.0):
         async for msg in kafka_consumer:
@@ -62,4 +51,36 @@ async def test_successful_refund(
                     'refund_test': '😎'
                 }
             }, value
-            break
\ No newline at end of file
+            break
+
+
+async def test_refund_batch(api_client: httpx.AsyncClient, create_payment: Callable[..., Awaitable[str]]):
+    payment_id = await create_payment()
+
+    body = [
+        {'payment_id': payment_id, 'amount': '40.00', 'currency': 'RUB'},
+        {'payment_id': str(uuid.uuid4()), 'amount': '10.00', 'currency': 'RUB'},
+        {'payment_id': payment_id, 'amount': '60.00', 'currency': 'RUB'}
+    ]
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+
+    response = await api_client.post('/api/v1/refund/batch', json=body, headers=headers)
+    assert response.status_code == 200, response.text
+    items = response.json()
+
+    # Ответ - в порядке запроса, несуществующий платеж - ошибка только своего элемента
+    assert items[0]['error'] is None and items[2]['error'] is None, items
+    assert items[1] == {'refund_id': None, 'error': 'payment with such id doesn\'t exist'}, items
+
+    async with db.postgres.session_maker() as session:
+        for item, expected in ((items[0], Decimal('40.00')), (items[2], Decimal('60.00'))):
+            refund = await session.get(tables.Refund, uuid.UUID(item['refund_id']))
+            assert refund is not None and refund.amount == expected
+
+    replay = await api_client.post('/api/v1/refund/batch', json=body, headers=headers)
+    assert replay.status_code == 200, replay.text
+    assert replay.json() == items
+
+    async with db.postgres.session_maker() as session:
+        refunds = await session.scalar(select(func.count()).where(tables.Refund.payment_id == uuid.UUID(payment_id)))
+    assert refunds == 2
@@ -0,0 +1,112 @@
+import httpx
+import uuid
+import asyncio
+from typing import Awaitable, Callable
+
+
+async def test_payment_status(api_client: httpx.AsyncClient, create_payment: Callable[..., Awaitable[str]]):
+    payment_id = await create_payment()
+
+    # Статус меняет воркер, кэш API сбрасывается уведомлением
+    async with asyncio.timeout(20.0):
+        while True:
+            response = await api_client.get(f'/api/v1/payment/{payment_id}')
+            assert response.status_code == 200, response.text
+            if response.json()['status'] == 'succeeded':
+                break
+            await asyncio.sleep(0.5)
+
+    body = response.json()
+    assert body['id'] == payment_id
+    assert body['amount'] == '100.00' and body['currency'] == 'RUB', body
+    etag = response.headers['ETag']
+
+    response = await api_client.get(f'/api/v1/payment/{payment_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304, response.text
+    assert response.headers['ETag'] == etag
+
+    response = await api_client.get(f'/api/v1/payment/{payment_id}', headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200, response.text
+    assert response.json() == body
+
+
+async def test_unknown_status(api_client: httpx.AsyncClient):
+    response = await api_client.get(f'/api/v1/payment/{uuid.uuid4()}')
+    assert response.status_code == 404, response.text
+
+    response = await api_client.get(f'/api/v1/refund/{uuid.uuid4()}')
+    assert response.status_code == 404, response.text
+
+
+async def test_refund_status(api_client: httpx.AsyncClient, create_payment: Callable[..., Awaitable[str]]):
+    payment_id = await create_payment()
+
+    response = await api_client.post('/api/v1/refund/batch', json=[
+        {'payment_id': payment_id, 'amount': '100.00', 'currency': 'RUB'}
+    ])
+    assert response.status_code == 200, response.text
+    refund_id = response.json()[0]['refund_id']
+
+    response = await api_client.get(f'/api/v1/refund/{refund_id}')
+    assert response.status_code == 200, response.text
+    assert response.json()['payment_id'] == payment_id
+    etag = response.headers['ETag']
+
+    response = await api_client.get(f'/api/v1/refund/{refund_id}', headers={'If-None-Match': f'W/{etag}'})
+    assert response.status_code in (200, 304), response.text
+    # 200 - только если статус успел измениться
+    if response.status_code == 200:
+        assert response.headers['ETag'] != etag
+
+
+async def test_wait_payment(api_client: httpx.AsyncClient, create_payment: Callable[..., Awaitable[str]]):
+    payment_id = await create_payment()
+
+    async with asyncio.timeout(30.0):
+        response = await api_client.get(f'/api/v1/payment/{payment_id}/wait', params={'timeout': 25})
+    assert response.status_code == 200, response.text
+    assert response.json()['status'] == 'succeeded', response.json()
+
+
+async def test_wait_payment_timeout(api_client: httpx.AsyncClient):
+    # Без card_data платеж ждет подтверждения пользователем и не завершится
+    response = await api_client.post('/api/v1/payment', json={
+        'user_id': str(uuid.uuid4()),
+        'return_url': 'https://example.com',
+        'amount': '100.00',
+        'currency': 'RUB'
+    })
+    assert response.status_code == 200, response.text
+    payment_id = response.json()['payment_id']
+
+    started = asyncio.get_running_loop().time()
+    response = await api_client.get(f'/api/v1/payment/{payment_id}/wait', params={'timeout': 2})
+    assert response.status_code == 200, response.text
+    assert response.json()['status'] not in ('succeeded', 'cancelled'), response.json()
+    assert asyncio.get_running_loop().time() - started >= 2.0
+
+
+async def test_wait_concurrent(api_client: httpx.AsyncClient, create_payment: Callable[..., Awaitable[str]]):
+    payment_id = await create_payment()
+
+    # Ожидающие не мешают друг другу, даже если один из них отменен
+    cancelled = asyncio.create_task(api_client.get(f'/api/v1/payment/{payment_id}/wait', params={'timeout': 25}))
+    waiting = [
+        asyncio.create_task(api_client.get(f'/api/v1/payment/{payment_id}/wait', params={'timeout': 25}))
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0.1)
+    cancelled.cancel()
+
+    async with asyncio.timeout(30.0):
+        for response in await asyncio.gather(*waiting):
+            assert response.status_code == 200, response.text
+            assert response.json()['status'] == 'succeeded', response.json()
+
+
+async def test_wait_invalid(api_client: httpx.AsyncClient):
+    response = await api_client.get(f'/api/v1/payment/{uuid.uuid4()}/wait', params={'timeout': 1})
+    assert response.status_code == 404, response.text
+
+    response = await api_client.get(f'/api/v1/payment/{uuid.uuid4()}/wait', params={'timeout': 1000})
+    assert response.status_code == 422, response.text
@@ -0,0 +1,70 @@
+import httpx
+import uuid
+import aiokafka
+import asyncio
+import json
+from typing import Awaitable, Callable
+from sqlalchemy import select
+
+import db.postgres
+import tables
+
+
+# Заменяет Yookassa, отправляя уведомление так же, как она
+# https://yookassa.ru/developers/using-api/webhooks#notification-object
+async def send_notification(
+    api_client: httpx.AsyncClient,
+    event: str,
+    yookassa_payment_id: str,
+    status: str
+):
+    return await api_client.post('/api/v1/yookassa/notifications', json={
+        'type': 'notification',
+        'event': event,
+        'object': {
+            'id': yookassa_payment_id,
+            'status': status,
+            'paid': status == 'succeeded'
+        }
+    })
+
+
+async def test_unknown_payment_notification(api_client: httpx.AsyncClient):
+    response = await send_notification(api_client, 'payment.succeeded', str(uuid.uuid4()), 'succeeded')
+    assert response.status_code == 200, response.text
+
+
+async def test_invalid_notification(api_client: httpx.AsyncClient):
+    response = await api_client.post('/api/v1/yookassa/notifications', json={'event': 'payment.succeeded'})
+    assert response.status_code == 422, response.text
+
+
+async def test_payment_notification(
+    api_client: httpx.AsyncClient,
+    kafka_consumer: aiokafka.AIOKafkaConsumer,
+    create_payment: Callable[..., Awaitable[str]],
+):
+    payment_id = await create_payment()
+
+    async with db.postgres.session_maker() as session:
+        external_id = await session.scalar(
+            select(tables.Payment.external_id)
+            .where(tables.Payment.id == uuid.UUID(payment_id))
+        )
+    assert external_id is not None
+
+    response = await send_notification(api_client, 'payment.succeeded', external_id, 'succeeded')
+    assert response.status_code == 200, response.text
+
+    async with asyncio.timeout(20.0):
+        async for msg in kafka_consumer:
+            assert msg.topic == 'payment'
+            assert isinstance(msg.value, bytes), msg
+            value = json.loads(msg.value.decode())
+
+            assert value == {
+                'id': payment_id,
+                'status': 'succeeded',
+                'extra_data': None
+            }, value
+            break